@@ -0,0 +1,109 @@
+import time
+
+# Stand-in for librespot's Session, only what OnTheSpot calls on it is implemented
+
+
+class FakeStoredToken:
+    def __init__(self, scope, expires_in=3600):
+        self.access_token = f'benchmark-token-{scope}'
+        self.expires_in = expires_in
+        # librespot stores the fetch time in microseconds
+        self.timestamp = int(time.time() * 1000000)
+
+
+class FakeTokenProvider:
+    def find_token_with_all_scopes(self, scopes):
+        # Every get_token call fetches a new token, nothing is cached
+        return None
+
+    def get_token(self, *scopes):
+        return FakeStoredToken(','.join(scopes))
+
+    def get(self, scope):
+        return self.get_token(scope).access_token
+
+
+def synthetic_ogg(size):
+    # Ogg page headers around filler, enough to look like a stream to anything sniffing the magic bytes
+    page = b'OggS\x00\x02' + b'\x00' * 20 + b'\x01\xff' + bytes(range(256)) * 16
+    return (page * (size // len(page) + 1))[:size]
+
+
+class FakeInputStream:
+    # Serves an in-memory payload at a fixed bandwidth, like AbsChunkedInputStream after the first chunks
+    def __init__(self, payload, bandwidth=0, stats=None):
+        self.size = len(payload)
+        self.__payload = memoryview(payload)
+        self.__bandwidth = bandwidth
+        self.__position = 0
+        self.__started = None
+        self.__stats = stats
+
+    def stream(self):
+        return self
+
+    def read(self, n=-1):
+        if self.__started is None:
+            self.__started = time.perf_counter()
+        if n is None or n < 0:
+            n = self.size - self.__position
+        data = bytes(self.__payload[self.__position:self.__position + n])
+        self.__position += len(data)
+        if self.__bandwidth:
+            # Sleep until the bytes handed out so far fit in the configured bandwidth
+            due = self.__started + self.__position / self.__bandwidth
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if self.__position >= self.size and self.__stats is not None:
+            self.__stats.add('stream', time.perf_counter() - self.__started)
+            self.__stats = None
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class FakeLoadedStream:
+    def __init__(self, input_stream):
+        self.input_stream = input_stream
+
+
+class FakeContentFeeder:
+    def __init__(self, payload, bandwidth, stats):
+        self.__payload = payload
+        self.__bandwidth = bandwidth
+        self.__stats = stats
+
+    def load(self, playable_id, audio_quality_picker, preload, halt_listener):
+        return FakeLoadedStream(FakeInputStream(self.__payload, self.__bandwidth, self.__stats))
+
+
+class FakeSession:
+    def __init__(self, track_size=65536, bandwidth=0, stats=None, payload=None, premium=True):
+        self.__payload = payload if payload is not None else synthetic_ogg(track_size)
+        self.__feeder = FakeContentFeeder(self.__payload, bandwidth, stats)
+        self.__tokens = FakeTokenProvider()
+        self.__premium = premium
+
+    def content_feeder(self):
+        return self.__feeder
+
+    def tokens(self):
+        return self.__tokens
+
+    def get_user_attribute(self, name, fallback=None):
+        if name == 'type':
+            return 'premium' if self.__premium else 'free'
+        return fallback
+
+    def username(self):
+        return 'benchmark'
+
+    def close(self):
+        pass
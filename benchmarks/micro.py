@@ -0,0 +1,280 @@
+import argparse
+import json
+import os
+import platform
+import struct
+import sys
+import tempfile
+import time
+
+from pipeline import isolate
+
+# Microbenchmarks for the helpers that run at least once per track. Results are compared against a stored
+# baseline and the run fails when a case got slower than its baseline by more than the threshold:
+#   python benchmarks/micro.py --save-baseline
+#   python benchmarks/micro.py --threshold 0.25
+# Baselines only mean something on the machine they were recorded on, save a fresh one before comparing.
+# Times are per run of a case, most cases work through a batch of BATCH synthetic items per run.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+BATCH = 100
+AUDIO_FORMATS = ['mp3', 'flac', 'ogg', 'm4a']
+
+
+def fake_mp3(path):
+    # An empty ID3 tag followed by a second of silent 128kbps MPEG-1 Layer III frames
+    frame = b'\xff\xfb\x90\x00' + b'\x00' * 413
+    with open(path, 'wb') as f:
+        f.write(b'ID3\x04\x00\x00\x00\x00\x00\x00' + frame * 38)
+
+
+def fake_flac(path):
+    # A lone STREAMINFO block, mutagen never looks at audio frames
+    info = struct.pack('>HH3s3s', 4096, 4096, b'\x00' * 3, b'\x00' * 3)
+    info += ((44100 << 44) | (1 << 41) | (15 << 36) | 44100).to_bytes(8, 'big') + b'\x00' * 16
+    with open(path, 'wb') as f:
+        f.write(b'fLaC' + bytes([0x80]) + len(info).to_bytes(3, 'big') + info)
+
+
+def fake_ogg(path):
+    from mutagen.ogg import OggPage
+    ident = b'\x01vorbis' + struct.pack('<IBIiiiBB', 0, 2, 44100, 0, 128000, 0, 0xb8, 1)
+    vendor = b'OnTheSpot benchmark'
+    comment = b'\x03vorbis' + struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', 0) + b'\x01'
+    setup = b'\x05vorbis' + b'\x00' * 32
+    pages = []
+    for sequence, (packets, position) in enumerate([([ident], 0), ([comment, setup], 0), ([b'\x00' * 4096], 44100)]):
+        page = OggPage()
+        page.serial = 1
+        page.sequence = sequence
+        page.position = position
+        page.packets = packets
+        page.first = sequence == 0
+        page.last = sequence == 2
+        pages.append(page.write())
+    with open(path, 'wb') as f:
+        f.write(b''.join(pages))
+
+
+def fake_m4a(path):
+    def atom(name, payload):
+        return struct.pack('>I', len(payload) + 8) + name + payload
+    mvhd = struct.pack('>IIIII', 0, 0, 0, 1000, 1000) + b'\x00' * 80
+    with open(path, 'wb') as f:
+        f.write(atom(b'ftyp', b'M4A \x00\x00\x00\x00M4A mp42isom') + atom(b'moov', atom(b'mvhd', mvhd))
+                + atom(b'mdat', b'\x00' * 4096))
+
+
+FAKE_AUDIO = {'mp3': fake_mp3, 'flac': fake_flac, 'ogg': fake_ogg, 'm4a': fake_m4a}
+
+
+def synthetic_song_info(i, image_url=''):
+    return {
+        'artists': [f'Artist {i}', f'Featured/Artist {i + 1}', 'AC:DC'],
+        'album_name': f'Album {i // 12}: Deluxe Edition',
+        'album_type': 'album',
+        'album_artists': f'Artist {i}',
+        'name': f'Track {i} (Remastered 2011) / Part "{i % 3}"',
+        'image_url': image_url,
+        'release_year': '2011',
+        'track_number': i % 12 + 1,
+        'total_tracks': 12,
+        'disc_number': 1,
+        'total_discs': 1,
+        'genre': ['rock', 'hard rock', 'album rock'],
+        'performers': [f'Performer {n}' for n in range(4)],
+        'producers': [f'Producer {n}' for n in range(2)],
+        'writers': [f'Writer {n}' for n in range(3)],
+        'label': 'Benchmark Records',
+        'copyright': ['(C) 2011 Benchmark Records', '(P) 2011 Benchmark Records'],
+        'explicit': i % 5 == 0,
+        'isrc': f'USBM1{i:07d}',
+        'length': 180000 + i * 1000 % 120000,
+        'scraped_song_id': f'{i:022d}',
+        'is_playable': True,
+    }
+
+
+def synthetic_lyrics(lines=60):
+    return {'lyrics': {
+        'syncType': 'LINE_SYNCED',
+        'provider': 'MusixMatch',
+        'language': 'en',
+        'lines': [{'startTimeMs': str(n * 3170), 'words': f'Line {n} of a synthetic song', 'syllables': []}
+                  for n in range(lines)],
+    }}
+
+
+def synthetic_search_items(i):
+    artists = [{'name': f'Artist {i}'}, {'name': f'Artist {i + 1}'}]
+    images = [{'url': f'https://i.scdn.co/image/{size}', 'height': size, 'width': size} for size in [64, 300, 640]]
+    return {
+        'tracks': {'name': f'Track {i}', 'explicit': i % 2 == 0, 'artists': artists},
+        'albums': {'name': f'Album {i}', 'release_date': '2011-06-01', 'total_tracks': 12, 'artists': artists},
+        'playlists': {'name': f'Playlist {i}', 'owner': {'display_name': 'benchmark'}},
+        'artists': {'name': f'Artist {i}', 'genres': ['rock', 'hard rock']},
+        'shows': {'name': f'Show {i}', 'explicit': False, 'publisher': 'Benchmark Media'},
+        'episodes': {'name': f'Episode {i}', 'explicit': False},
+        'audiobooks': {'name': f'Audiobook {i}', 'explicit': False, 'publisher': 'Benchmark Books'},
+        'images': images,
+    }
+
+
+def synthetic_urls():
+    kinds = ['track', 'album', 'playlist', 'episode', 'show', 'artist']
+    urls = []
+    for i in range(BATCH):
+        kind = kinds[i % len(kinds)]
+        object_id = f'{i:022d}'
+        urls.append([f'spotify:{kind}:{object_id}',
+                     f'https://open.spotify.com/{kind}/{object_id}?si=abcdef1234567890',
+                     f'https://open.spotify.com/intl-de/{kind}/{object_id}'][i % 3])
+    return urls
+
+
+def build_cases(workdir, image_url):
+    from onthespot.otsconfig import config
+    from onthespot.runtimedata import downloaded_data
+    from onthespot.utils.utils import sanitize_data, get_url_data, name_by_from_sdata
+    from onthespot.spotify.api import get_thumbnail, conv_list_format, format_lyrics, set_audio_tags, \
+        set_music_thumbnail
+    from onthespot.spotify.utility import write_m3u_playlist
+
+    for key in ['embed_branding', 'embed_artist', 'embed_album', 'embed_albumartist', 'embed_name', 'embed_year',
+                'embed_discnumber', 'embed_tracknumber', 'embed_genre', 'embed_performers', 'embed_producers',
+                'embed_writers', 'embed_label', 'embed_copyright', 'embed_description', 'embed_length',
+                'embed_cover']:
+        config.set_(key, True)
+    config.set_('save_album_cover', False)
+
+    infos = [synthetic_song_info(i, image_url) for i in range(BATCH)]
+    names = [value for info in infos for value in [info['name'], info['album_name'], info['artists'][1]]][:BATCH]
+    urls = synthetic_urls()
+    search_items = [synthetic_search_items(i) for i in range(BATCH)]
+    lyrics = synthetic_lyrics()
+    for i, info in enumerate(infos):
+        downloaded_data[info['scraped_song_id']] = {
+            'media_name': info['name'], 'media_path': os.path.join(workdir, 'music', f'{info["name"]}.ogg')}
+    playlist = [info['scraped_song_id'] for info in infos]
+
+    cases = {
+        'sanitize_data': lambda: [sanitize_data(name) for name in names],
+        'sanitize_data_path': lambda: [sanitize_data(name, allow_path_separators=True) for name in names],
+        'get_url_data': lambda: [get_url_data(url) for url in urls],
+        'name_by_from_sdata': lambda: [name_by_from_sdata(d_key, item[d_key]) for item in search_items
+                                       for d_key in ['tracks', 'albums', 'playlists', 'artists', 'shows',
+                                                     'episodes', 'audiobooks']],
+        'get_thumbnail': lambda: [get_thumbnail(item['images'], preferred_size=640000) for item in search_items],
+        'conv_list_format': lambda: [conv_list_format(info['artists']) for info in infos],
+        'format_lyrics': lambda: [format_lyrics(lyrics, info['scraped_song_id'], 'track', info, False)
+                                  for info in infos],
+        'write_m3u_playlist': lambda: write_m3u_playlist('benchmark', os.path.join(workdir, 'playlist.m3u8'),
+                                                         playlist),
+    }
+    for fmt in AUDIO_FORMATS:
+        path = os.path.join(workdir, f'track.{fmt}')
+        FAKE_AUDIO[fmt](path)
+        cases[f'set_audio_tags_{fmt}'] = lambda path=path: set_audio_tags(path, infos[0], infos[0]['scraped_song_id'])
+        cases[f'set_music_thumbnail_{fmt}'] = lambda path=path: set_music_thumbnail(path, image_url)
+    return cases
+
+
+def measure(func, min_time, repeat):
+    # Pick a loop count that makes one repeat last at least min_time, then keep the fastest repeat
+    func()
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        best = min(best, time.perf_counter() - start)
+    return best / loops * 1000000
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    rows = []
+    for name, us in sorted(results.items()):
+        entry = baseline.get(name)
+        if entry is None:
+            rows.append((name, us, None, None, 'new'))
+            continue
+        limit = entry.get('threshold', threshold)
+        ratio = us / entry['us'] if entry['us'] else 1
+        status = 'ok'
+        if ratio > 1 + limit:
+            status = f'REGRESSED (> {limit:.0%})'
+            regressions.append(name)
+        elif ratio < 1 - limit:
+            status = 'faster'
+        rows.append((name, us, entry['us'], ratio, status))
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Microbenchmarks for per track helpers with regression checks.')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline results file')
+    parser.add_argument('--save-baseline', action='store_true', help='Store this run as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed slowdown against the baseline, 0.2 fails a case 20%% slower than it')
+    parser.add_argument('--filter', default='', help='Only run cases whose name contains this')
+    parser.add_argument('--min-time', type=float, default=0.2, help='Seconds every repeat runs for')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='ots-micro-')
+    isolate(workdir)
+    sys.path.insert(0, BENCH_DIR)
+    from mock_backend import Catalog, MockBackend
+    from onthespot.spotify.http_client import client
+
+    # Covers come from the mock backend, after the first fetch the cover cache serves them from memory
+    backend = MockBackend(Catalog(1)).start()
+    client.override_host('i.scdn.co', backend.url)
+    cases = build_cases(workdir, 'https://i.scdn.co/image/benchmark')
+
+    results = {}
+    for name, func in cases.items():
+        if args.filter in name:
+            results[name] = measure(func, args.min_time, args.repeat)
+    backend.stop()
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+    rows, regressions = compare(results, baseline, args.threshold)
+    print(f"{'case':<28}{'us/run':>12}{'baseline':>12}{'ratio':>8}  status")
+    for name, us, base, ratio, status in rows:
+        base = '' if base is None else f'{base:.1f}'
+        ratio = '' if ratio is None else f'{ratio:.2f}'
+        print(f"{name:<28}{us:>12.1f}{base:>12}{ratio:>8}  {status}")
+
+    if args.save_baseline:
+        # Cases left out by --filter keep their old numbers, hand tuned per case thresholds are kept too
+        saved = dict(baseline)
+        for name, us in results.items():
+            saved[name] = dict(baseline.get(name, {}), us=round(us, 3))
+        with open(args.baseline, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'system': platform.system(), 'batch': BATCH, 'results': saved}, f, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+    if regressions:
+        print(f"{len(regressions)} regressed: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
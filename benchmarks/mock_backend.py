@@ -0,0 +1,415 @@
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from PIL import Image
+
+BASE62 = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+# Every kind of object gets its own id range so ids can be decoded back to an index
+KINDS = ['track', 'album', 'artist', 'playlist', 'show', 'episode']
+_KIND_SPAN = 10 ** 12
+# Roughly what a real catalog entry carries, dropped again when market is set like the real api does
+MARKETS = ['AD', 'AE', 'AR', 'AT', 'AU', 'BE', 'BG', 'BR', 'CA', 'CH', 'CL', 'CO', 'CZ', 'DE', 'DK', 'EE', 'ES',
+           'FI', 'FR', 'GB', 'GR', 'HK', 'HU', 'ID', 'IE', 'IL', 'IN', 'IS', 'IT', 'JP', 'LT', 'MX', 'MY', 'NL',
+           'NO', 'NZ', 'PH', 'PL', 'PT', 'RO', 'SE', 'SG', 'SK', 'TH', 'TR', 'TW', 'US', 'VN', 'ZA'] * 4
+
+
+def encode_id(kind, index):
+    n = KINDS.index(kind) * _KIND_SPAN + index
+    digits = ''
+    while n:
+        n, r = divmod(n, 62)
+        digits = BASE62[r] + digits
+    return digits.rjust(22, '0')
+
+
+def decode_id(object_id):
+    n = 0
+    for char in object_id:
+        n = n * 62 + BASE62.index(char)
+    return KINDS[n // _KIND_SPAN], n % _KIND_SPAN
+
+
+class Catalog:
+    # A deterministic synthetic catalog: tracks are grouped into albums, albums are spread over artists, one
+    # playlist holds every track and one show holds every episode
+    def __init__(self, tracks, album_size=12, albums_per_artist=4, episodes=0, base_url=''):
+        self.tracks = tracks
+        self.album_size = album_size
+        self.albums = max(1, -(-tracks // album_size))
+        self.artists = max(1, self.albums // albums_per_artist)
+        self.episodes = episodes
+        self.base_url = base_url
+        self.playlist_id = encode_id('playlist', 0)
+        self.show_id = encode_id('show', 0)
+
+    def images(self, object_id):
+        return [{'url': f'{self.base_url}/image/{object_id}', 'height': size, 'width': size}
+                for size in [640, 300, 64]]
+
+    def artist(self, index, full=False):
+        artist = {'id': encode_id('artist', index), 'name': f'Artist {index}', 'type': 'artist'}
+        if full:
+            artist.update(genres=['benchmark', f'genre {index % 7}'], popularity=index % 100,
+                          images=self.images(artist['id']))
+        return artist
+
+    def album(self, index, full=False, market=False):
+        album_id = encode_id('album', index)
+        first = index * self.album_size
+        album = {
+            'id': album_id,
+            'name': f'Album {index}',
+            'type': 'album',
+            'album_type': 'album',
+            'artists': [self.artist(index % self.artists)],
+            'images': self.images(album_id),
+            'release_date': f'{2000 + index % 25}-01-01',
+            'total_tracks': min(self.album_size, self.tracks - first),
+        }
+        if not market:
+            album['available_markets'] = MARKETS
+        if full:
+            album.update(label=f'Label {index % 13}', genres=[],
+                         copyrights=[{'text': f'(C) Label {index % 13}', 'type': 'C'}],
+                         tracks=self.album_tracks(index, 0, 50, market))
+        return album
+
+    def track(self, index, simplified=False, market=False):
+        album_index = index // self.album_size
+        track = {
+            'id': encode_id('track', index),
+            'name': f'Track {index}',
+            'type': 'track',
+            'artists': [self.artist(album_index % self.artists)],
+            'track_number': index % self.album_size + 1,
+            'disc_number': 1,
+            'duration_ms': 180000 + index % 60000,
+            'explicit': index % 9 == 0,
+            'is_playable': True,
+        }
+        if not market:
+            track['available_markets'] = MARKETS
+        if not simplified:
+            track.update(album=self.album(album_index, market=market), popularity=index % 100,
+                         external_ids={'isrc': f'BENCH{index:07d}'})
+        return track
+
+    def album_tracks(self, album_index, offset, limit, market=False):
+        first = album_index * self.album_size
+        total = min(self.album_size, self.tracks - first)
+        items = [self.track(first + i, simplified=True, market=market)
+                 for i in range(offset, min(offset + limit, total))]
+        return self.page(items, total, offset, limit, f'/v1/albums/{encode_id("album", album_index)}/tracks')
+
+    def episode(self, index, market=False):
+        episode_id = encode_id('episode', index)
+        episode = {
+            'id': episode_id,
+            'name': f'Episode {index}',
+            'type': 'episode',
+            'images': self.images(episode_id),
+            'release_date': f'{2000 + index % 25}-01-01',
+            'language': 'en',
+            'description': f'Synthetic episode {index}',
+            'duration_ms': 1800000,
+        }
+        if not market:
+            episode['available_markets'] = MARKETS
+        return episode
+
+    def show(self, market=False):
+        return {
+            'id': self.show_id,
+            'name': 'Benchmark Show',
+            'type': 'show',
+            'publisher': 'Benchmark',
+            'languages': ['en'],
+            'description': 'Synthetic show',
+            'copyrights': [],
+            'images': self.images(self.show_id),
+            'total_episodes': self.episodes,
+        }
+
+    def page(self, items, total, offset, limit, path):
+        next_url = None
+        if offset + limit < total:
+            next_url = f'{self.base_url}{path}?{urlencode({"offset": offset + limit, "limit": limit})}'
+        return {'items': items, 'total': total, 'offset': offset, 'limit': limit, 'next': next_url}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        parts = urlsplit(self.path)
+        query = dict(parse_qsl(parts.query))
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        for pattern, route in ROUTES:
+            match = pattern.match(parts.path)
+            if match:
+                try:
+                    result = route(server.catalog, query, *match.groups())
+                except (ValueError, IndexError):
+                    result = None
+                break
+        else:
+            result = None
+        if result is None:
+            self.send_body(404, b'{"error": {"status": 404, "message": "Not found"}}', 'application/json')
+        elif isinstance(result, bytes):
+            self.send_body(200, result, 'image/jpeg')
+        else:
+            self.send_body(200, json.dumps(result).encode(), 'application/json')
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _index(object_id, kind, limit):
+    found, index = decode_id(object_id)
+    if found != kind or index >= limit:
+        raise ValueError(object_id)
+    return index
+
+
+def _ids(query, kind, limit):
+    return [_index(object_id, kind, limit) for object_id in query['ids'].split(',')]
+
+
+def _paging(query, default_limit=20):
+    return int(query.get('offset', 0)), int(query.get('limit', default_limit))
+
+
+def route_tracks(catalog, query):
+    market = 'market' in query
+    return {'tracks': [catalog.track(i, market=market) for i in _ids(query, 'track', catalog.tracks)]}
+
+
+def route_albums(catalog, query):
+    market = 'market' in query
+    return {'albums': [catalog.album(i, full=True, market=market) for i in _ids(query, 'album', catalog.albums)]}
+
+
+def route_album(catalog, query, album_id):
+    return catalog.album(_index(album_id, 'album', catalog.albums), full=True, market='market' in query)
+
+
+def route_album_tracks(catalog, query, album_id):
+    offset, limit = _paging(query)
+    return catalog.album_tracks(_index(album_id, 'album', catalog.albums), offset, limit, 'market' in query)
+
+
+def route_artists(catalog, query):
+    return {'artists': [catalog.artist(i, full=True) for i in _ids(query, 'artist', catalog.artists)]}
+
+
+def route_artist(catalog, query, artist_id):
+    return catalog.artist(_index(artist_id, 'artist', catalog.artists), full=True)
+
+
+def route_artist_albums(catalog, query, artist_id):
+    index = _index(artist_id, 'artist', catalog.artists)
+    offset, limit = _paging(query)
+    albums = range(index, catalog.albums, catalog.artists)
+    items = [catalog.album(i) for i in albums[offset:offset + limit]]
+    return catalog.page(items, len(albums), offset, limit, f'/v1/artists/{artist_id}/albums')
+
+
+def route_playlist(catalog, query, playlist_id):
+    _index(playlist_id, 'playlist', 1)
+    return {
+        'id': playlist_id,
+        'name': 'Benchmark Playlist',
+        'description': f'{catalog.tracks} synthetic tracks',
+        'owner': {'display_name': 'benchmark'},
+        'external_urls': {'spotify': f'https://open.spotify.com/playlist/{playlist_id}'},
+        'snapshot_id': f'bench-{catalog.tracks}',
+    }
+
+
+def route_playlist_tracks(catalog, query, playlist_id):
+    _index(playlist_id, 'playlist', 1)
+    offset, limit = _paging(query, 100)
+    items = [{'track': catalog.track(i, market='market' in query)}
+             for i in range(offset, min(offset + limit, catalog.tracks))]
+    return catalog.page(items, catalog.tracks, offset, limit, f'/v1/playlists/{playlist_id}/tracks')
+
+
+def route_show(catalog, query, show_id):
+    _index(show_id, 'show', 1)
+    show = catalog.show()
+    show['episodes'] = route_show_episodes(catalog, {'limit': 50}, show_id)
+    return show
+
+
+def route_show_episodes(catalog, query, show_id):
+    _index(show_id, 'show', 1)
+    offset, limit = _paging(query)
+    items = [catalog.episode(i, 'market' in query) for i in range(offset, min(offset + limit, catalog.episodes))]
+    return catalog.page(items, catalog.episodes, offset, limit, f'/v1/shows/{show_id}/episodes')
+
+
+def route_episodes(catalog, query):
+    return {'episodes': [dict(catalog.episode(i, 'market' in query), show=catalog.show())
+                         for i in _ids(query, 'episode', catalog.episodes)]}
+
+
+def route_episode(catalog, query, episode_id):
+    return dict(catalog.episode(_index(episode_id, 'episode', catalog.episodes), 'market' in query),
+                show=catalog.show())
+
+
+def route_search(catalog, query):
+    offset, limit = _paging(query)
+    results = {}
+    for c_type in query['type'].split(','):
+        if c_type == 'track':
+            total, build = catalog.tracks, lambda i: catalog.track(i, market='market' in query)
+        elif c_type == 'album':
+            total, build = catalog.albums, lambda i: catalog.album(i, market='market' in query)
+        elif c_type == 'artist':
+            total, build = catalog.artists, lambda i: catalog.artist(i, full=True)
+        elif c_type == 'playlist':
+            total, build = 1, lambda i: dict(route_playlist(catalog, query, catalog.playlist_id),
+                                             images=catalog.images(catalog.playlist_id))
+        elif c_type == 'show':
+            total, build = 1 if catalog.episodes else 0, lambda i: catalog.show()
+        elif c_type == 'episode':
+            total, build = catalog.episodes, lambda i: catalog.episode(i, 'market' in query)
+        else:
+            total, build = 0, None
+        items = [build(i) for i in range(offset, min(offset + limit, total))]
+        results[c_type + 's'] = catalog.page(items, total, offset, limit, '/v1/search')
+    return results
+
+
+AUDIO_FEATURES = {'key': 5, 'tempo': 120.0, 'time_signature': 4, 'acousticness': 0.1, 'danceability': 0.5,
+                  'energy': 0.7, 'instrumentalness': 0.0, 'liveness': 0.1, 'loudness': -6.0, 'speechiness': 0.05,
+                  'valence': 0.5}
+
+
+def route_audio_features(catalog, query, track_id=None):
+    if track_id is not None:
+        return dict(AUDIO_FEATURES, id=track_id)
+    return {'audio_features': [dict(AUDIO_FEATURES, id=encode_id('track', i))
+                               for i in _ids(query, 'track', catalog.tracks)]}
+
+
+def route_credits(catalog, query, track_id):
+    index = _index(track_id, 'track', catalog.tracks)
+    artist = catalog.artist(index // catalog.album_size % catalog.artists)
+    return {'roleCredits': [{'roleTitle': role, 'artists': [{'name': artist['name']}]}
+                            for role in ['Performers', 'Producers', 'Writers']]}
+
+
+def route_lyrics(catalog, query, track_id):
+    index = _index(track_id, 'track', catalog.tracks)
+    if index % 4 == 3:
+        # A share of the catalog has no lyrics, like the real one
+        return None
+    lines = [{'startTimeMs': str(i * 4000), 'words': f'Line {i} of track {index}'} for i in range(40)]
+    return {'lyrics': {'syncType': 'LINE_SYNCED', 'provider': 'benchmark', 'language': 'en', 'lines': lines}}
+
+
+def route_transcript(catalog, query, episode_id):
+    _index(episode_id, 'episode', catalog.episodes)
+    return None
+
+
+def route_image(catalog, query, object_id):
+    return COVER
+
+
+def _cover():
+    buf = BytesIO()
+    Image.new('RGB', (640, 640), (30, 215, 96)).save(buf, format='JPEG', quality=85)
+    return buf.getvalue()
+
+
+COVER = _cover()
+
+ROUTES = [(re.compile(f'^{pattern}$'), route) for pattern, route in [
+    (r'/v1/tracks', route_tracks),
+    (r'/v1/albums', route_albums),
+    (r'/v1/albums/(\w+)', route_album),
+    (r'/v1/albums/(\w+)/tracks', route_album_tracks),
+    (r'/v1/artists', route_artists),
+    (r'/v1/artists/(\w+)', route_artist),
+    (r'/v1/artists/(\w+)/albums', route_artist_albums),
+    (r'/v1/playlists/(\w+)', route_playlist),
+    (r'/v1/playlists/(\w+)/tracks', route_playlist_tracks),
+    (r'/v1/shows/(\w+)', route_show),
+    (r'/v1/shows/(\w+)/episodes', route_show_episodes),
+    (r'/v1/episodes', route_episodes),
+    (r'/v1/episodes/(\w+)', route_episode),
+    (r'/v1/search', route_search),
+    (r'/v1/audio-features', route_audio_features),
+    (r'/v1/audio-features/(\w+)', route_audio_features),
+    (r'/track-credits-view/v0/experimental/(\w+)/credits', route_credits),
+    (r'/color-lyrics/v2/track/(\w+)', route_lyrics),
+    (r'/transcript-read-along/v2/episode/(\w+)', route_transcript),
+    (r'/image/(\w+)', route_image),
+]]
+
+
+class MockBackend:
+    # Serves the catalog on a local port, the api layer is pointed at it with HttpClient.override_host
+    def __init__(self, catalog, host='127.0.0.1', port=0, latency=0):
+        self.server = ThreadingHTTPServer((host, port), MockHandler)
+        self.server.daemon_threads = True
+        self.server.catalog = catalog
+        self.server.latency = latency
+        self.server.requests = 0
+        self.server.lock = threading.Lock()
+        self.url = f'http://{host}:{self.server.server_address[1]}'
+        catalog.base_url = self.url
+        self.__thread = None
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.server.serve_forever, name='mock-backend', daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve a synthetic Spotify catalog for benchmarks.')
+    parser.add_argument('--tracks', type=int, default=1000)
+    parser.add_argument('--episodes', type=int, default=100)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added to every response')
+    args = parser.parse_args(argv)
+    catalog = Catalog(args.tracks, episodes=args.episodes)
+    backend = MockBackend(catalog, port=args.port, latency=args.latency)
+    print(f'Serving {args.tracks} tracks at {backend.url}, playlist {catalog.playlist_id}, show {catalog.show_id}')
+    try:
+        backend.server.serve_forever()
+    except KeyboardInterrupt:
+        backend.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+import argparse
+import json
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Drives ParsingQueueProcessor -> download_queue -> DownloadWorker against the mock backend and a fake session.
+# Every job runs in its own process so peak RSS is not carried over between job sizes:
+#   python benchmarks/pipeline.py --jobs 1000,10000,100000 --workers 4
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'src')
+
+
+class StageStats:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__samples = {}
+
+    def add(self, stage, seconds):
+        with self.__lock:
+            self.__samples.setdefault(stage, []).append(seconds)
+
+    def timed(self, stage, func):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return wrapper
+
+    def summary(self):
+        with self.__lock:
+            samples = {stage: sorted(values) for stage, values in self.__samples.items()}
+        summary = {}
+        for stage, values in samples.items():
+            summary[stage] = {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 50) * 1000, 2),
+                'p90_ms': round(percentile(values, 90) * 1000, 2),
+                'p99_ms': round(percentile(values, 99) * 1000, 2),
+                'max_ms': round(values[-1] * 1000, 2),
+            }
+        return summary
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on linux, bytes on macos
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def isolate(workdir):
+    # Point config, cache and logs at a scratch directory before onthespot reads them at import time
+    for var in ['XDG_CONFIG_HOME', 'XDG_CACHE_HOME', 'APPDATA', 'TEMP']:
+        os.environ[var] = workdir
+    os.environ.setdefault('LOG_LEVEL', '30')
+    if SRC_DIR not in sys.path:
+        sys.path.insert(0, SRC_DIR)
+
+
+def run_job(args):
+    workdir = tempfile.mkdtemp(prefix='ots-bench-')
+    isolate(workdir)
+    sys.path.insert(0, BENCH_DIR)
+    from PyQt6.QtCore import Qt
+    from mock_backend import Catalog, MockBackend
+    from fake_session import FakeSession
+    from onthespot.otsconfig import config
+    from onthespot.runtimedata import session_pool, download_queue, failed_downloads
+    from onthespot.spotify import utility, downloader, postprocess
+    from onthespot.spotify.http_client import client
+    from onthespot.spotify.lyrics import lyrics_service
+    from onthespot.spotify.chunkreader import chunk_stats
+    from onthespot.spotify.api import network_stats
+
+    stats = StageStats()
+    catalog = Catalog(args.tracks, album_size=args.album_size)
+    backend = MockBackend(catalog, latency=args.latency).start()
+    for host in ['api.spotify.com', 'spclient.wg.spotify.com']:
+        client.override_host(host, backend.url)
+
+    payload = None
+    if args.sample:
+        with open(args.sample, 'rb') as f:
+            payload = f.read()
+    session = FakeSession(track_size=args.track_size, bandwidth=args.bandwidth * 1024, stats=stats,
+                          payload=payload)
+    session_uuid = 'benchmark'
+    session_pool[session_uuid] = session
+    config.set_('accounts', [['benchmark', 'premium', int(time.time()), session_uuid]])
+    config.set_('parsing_acc_sn', 1)
+    config.set_('rotate_acc_sn', False)
+    config.set_('download_root', os.path.join(workdir, 'downloads'))
+    config.set_('download_delay', 0)
+    config.set_('force_raw', not (args.convert or args.stream_convert))
+    config.set_('stream_conversion', args.stream_convert)
+    config.set_('inp_enable_lyrics', args.lyrics)
+    config.set_('use_lrc_file', args.lyrics)
+    config.set_('create_m3u_playlists', False)
+    config.set_('translate_file_path', False)
+    # The mock backend never throttles, neither should the client
+    config.set_('api_rate_limit', 1000000)
+    config.set_('api_rate_burst', 1000000)
+
+    downloader.get_song_info = stats.timed('metadata', downloader.get_song_info)
+    postprocess.convert_audio_format = stats.timed('convert', postprocess.convert_audio_format)
+    postprocess.set_audio_tags = stats.timed('tags', postprocess.set_audio_tags)
+    postprocess.set_music_thumbnail = stats.timed('cover', postprocess.set_music_thumbnail)
+    utility.get_song_info_many = stats.timed('prefetch_batch', utility.get_song_info_many)
+    lyrics_service.get = stats.timed('lyrics', lyrics_service.get)
+
+    enqueued = {}
+    started = {}
+    finished = {}
+    lock = threading.Lock()
+
+    def on_enqueue(item):
+        with lock:
+            enqueued[item['item_id']] = time.perf_counter()
+        download_queue.put({
+            'media_type': item['dl_params']['media_type'],
+            'media_id': item['item_id'],
+            'extra_paths': item['dl_params']['extra_paths'],
+            'extra_path_as_root': item['dl_params']['extra_path_as_root'],
+            'm3u_filename': '',
+            'playlist_name': item['dl_params'].get('playlist_name', ''),
+            'playlist_owner': item['dl_params'].get('playlist_owner', ''),
+            'playlist_desc': item['dl_params'].get('playlist_desc', ''),
+        })
+
+    def on_progress(data):
+        media_id, status = data[0], data[1]
+        now = time.perf_counter()
+        with lock:
+            if status == 'Downloading':
+                started.setdefault(media_id, now)
+            elif status in ['Downloaded', 'Already exists'] and media_id not in finished:
+                finished[media_id] = now
+                stats.add('queue_wait', started.get(media_id, now) - enqueued.get(media_id, now))
+                stats.add('download', now - started.get(media_id, now))
+                stats.add('total', now - enqueued.get(media_id, now))
+        if status == 'Downloaded' and len(data) > 3 and not args.keep_files and os.path.isfile(data[3]):
+            os.remove(data[3])
+
+    # Signals are delivered on the emitting thread, no Qt event loop runs in a headless benchmark
+    parsing_queue = queue.Queue()
+    parser = utility.ParsingQueueProcessor()
+    parser.setup(parsing_queue)
+    parser.enqueue.connect(on_enqueue, Qt.ConnectionType.DirectConnection)
+    threading.Thread(target=parser.run, name='parser', daemon=True).start()
+    workers = []
+    for i in range(args.workers):
+        worker = downloader.DownloadWorker()
+        worker.setup(thread_name=f'BENCH_DL_TH-{i}', session_uuid=session_uuid, queue_tracks=download_queue)
+        worker.progress.connect(on_progress, Qt.ConnectionType.DirectConnection)
+        thread = threading.Thread(target=worker.run, name=f'download-{i}', daemon=True)
+        workers.append((worker, thread))
+        thread.start()
+
+    start = time.perf_counter()
+    parsing_queue.put({'media_type': 'playlist', 'media_id': catalog.playlist_id, 'data': {'hide_dialogs': True}})
+    deadline = start + args.timeout
+    while time.perf_counter() < deadline:
+        with lock:
+            done = len(finished)
+        if done + len(failed_downloads) >= args.tracks:
+            break
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    for worker, _ in workers:
+        worker.stop()
+    for _, thread in workers:
+        thread.join(timeout=5)
+    backend.stop()
+
+    with lock:
+        first_enqueue = min(enqueued.values()) - start if enqueued else None
+        done = len(finished)
+    return {
+        'tracks': args.tracks,
+        'workers': args.workers,
+        'completed': done,
+        'failed': len(failed_downloads),
+        'timed_out': done + len(failed_downloads) < args.tracks,
+        'elapsed_s': round(elapsed, 2),
+        'tracks_per_minute': round(done / elapsed * 60, 1) if elapsed else 0,
+        'first_enqueue_s': round(first_enqueue, 3) if first_enqueue is not None else None,
+        'api_requests': backend.requests,
+        'peak_rss_mb': peak_rss_mb(),
+        'stages': stats.summary(),
+        'chunks': chunk_stats.stats(),
+        'network': network_stats(),
+    }
+
+
+def print_report(result):
+    print(f"{result['tracks']} tracks, {result['workers']} workers: {result['completed']} completed, "
+          f"{result['failed']} failed{' (timed out)' if result['timed_out'] else ''}")
+    print(f"  {result['tracks_per_minute']} tracks/min over {result['elapsed_s']}s, first track queued after "
+          f"{result['first_enqueue_s']}s, {result['api_requests']} api requests, peak RSS {result['peak_rss_mb']} MB")
+    chunks = result['chunks']
+    print(f"  {chunks['reads']} chunk reads, mean {chunks['mean_chunk']} bytes, reads by size: "
+          f"{', '.join(f'<={size // 1024}K: {count}' for size, count in chunks['sizes'].items())}")
+    network = result['network']
+    print(f"  api budget waited {network['scheduler']['waited']}s, {network['scheduler']['throttled']} throttled, "
+          f"{network['scheduler']['retried']} retried")
+    for host, host_stats in network['http'].items():
+        print(f"  {host}: {host_stats['requests']} requests over {host_stats['connections']} connections")
+    print("  memory caches: " + ', '.join(f"{name} {s['hits']} hits/{s['misses']} misses"
+                                          for name, s in network['memory_caches'].items()))
+    print(f"  {'stage':<16}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, s in sorted(result['stages'].items()):
+        print(f"  {stage:<16}{s['count']:>8}{s['p50_ms']:>10}{s['p90_ms']:>10}{s['p99_ms']:>10}{s['max_ms']:>10}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='End to end download pipeline benchmark against a mock backend.')
+    parser.add_argument('--tracks', type=int, default=1000, help='Size of the benchmark playlist')
+    parser.add_argument('--jobs', default=None, help='Comma separated playlist sizes, each run in its own process')
+    parser.add_argument('--workers', type=int, default=1, help='Number of download workers')
+    parser.add_argument('--album-size', type=int, default=12)
+    parser.add_argument('--track-size', type=int, default=65536, help='Bytes of audio streamed per track')
+    parser.add_argument('--bandwidth', type=int, default=0, help='Stream bandwidth in KiB/s, 0 for unlimited')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds the mock backend adds to every response')
+    parser.add_argument('--sample', default=None, help='Audio file streamed instead of synthetic data')
+    parser.add_argument('--convert', action='store_true', help='Convert and tag files, needs ffmpeg and --sample')
+    parser.add_argument('--stream-convert', action='store_true', help='Like --convert, piping the stream into ffmpeg')
+    parser.add_argument('--lyrics', action='store_true', help='Fetch lyrics and write .lrc files')
+    parser.add_argument('--keep-files', action='store_true', help='Keep downloaded files instead of deleting them')
+    parser.add_argument('--timeout', type=float, default=3600)
+    parser.add_argument('--json', default=None, help='Write the results to this file')
+    args = parser.parse_args(argv)
+
+    if args.jobs:
+        results = []
+        forwarded = ['--workers', str(args.workers), '--album-size', str(args.album_size),
+                     '--track-size', str(args.track_size), '--bandwidth', str(args.bandwidth),
+                     '--latency', str(args.latency), '--timeout', str(args.timeout)]
+        if args.sample:
+            forwarded += ['--sample', args.sample]
+        forwarded += [flag for flag, enabled in [('--convert', args.convert), ('--stream-convert', args.stream_convert),
+                                                 ('--lyrics', args.lyrics), ('--keep-files', args.keep_files)]
+                      if enabled]
+        for size in [int(size) for size in args.jobs.split(',')]:
+            with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+                out = f.name
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--tracks', str(size), '--json', out]
+                           + forwarded, check=True)
+            with open(out, 'r') as f:
+                results.append(json.load(f))
+            os.remove(out)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+        return 0
+
+    result = run_job(args)
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 1 if result['timed_out'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
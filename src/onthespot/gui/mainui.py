@@ -7,26 +7,41 @@ from PyQt6 import uic, QtNetwork, QtGui
 from PyQt6.QtCore import QThread, QDir, Qt
 from PyQt6.QtGui import QIcon
 from PyQt6.QtWidgets import QApplication, QMainWindow, QHeaderView, QLabel, QPushButton, QProgressBar, QTableWidgetItem, QFileDialog
-from ..exceptions import EmptySearchResultException
-from ..spotify.api import search_by_term, get_thumbnail
-from ..utils.utils import fetch_account_uuid, name_by_from_sdata, login_user, remove_user, get_url_data, re_init_session, latest_release, open_item
-from ..spotify import LoadSessions, ParsingQueueProcessor, MediaWatcher, PlayListMaker, DownloadWorker
+from ..spotify.api import get_thumbnail
+from ..utils.utils import name_by_from_sdata, login_user, remove_user, get_url_data, latest_release, open_item
+from ..spotify import LoadSessions, ParsingQueueProcessor, MediaWatcher, PlayListMaker, DownloadWorker, SearchWorker
 from ..spotify.zeroconf import new_session
+from ..spotify.progress import progress_aggregator
+from ..spotify.postprocess import sweep_staging
 from .dl_progressbtn import DownloadActionsButtons
 from .minidialog import MiniDialog
 from ..otsconfig import config_dir, config
 from ..runtimedata import get_logger, download_queue, downloads_status, downloaded_data, failed_downloads, cancel_list, \
     session_pool, thread_pool
 from .thumb_listitem import LabelWithThumb
-from urllib3.exceptions import MaxRetryError, NewConnectionError
 
 logger = get_logger('gui.main_ui')
 
 
+def dl_progress_batch(items):
+    # Byte counters of every active download, published by the progress aggregator's timer
+    for media_id, progress in items.items():
+        try:
+            if progress[1]:
+                downloads_status[media_id]["progress_bar"].setValue(int((progress[0] / progress[1]) * 100))
+        except (KeyError, RuntimeError):
+            logger.debug(f"Got progress for media_id '{media_id}' which is no longer listed")
+
+
 def dl_progress_update(data):
     media_id = data[0]
     status = data[1]
     progress = data[2]
+    if status is not None:
+        # Counters still waiting for the next batch are older than this status change
+        pending = progress_aggregator.take(media_id)
+        if pending is not None:
+            dl_progress_batch({media_id: pending})
     try:
         if status is not None:
             if progress == [0, 100]:
@@ -149,7 +164,12 @@ class MainWindow(QMainWindow):
         # Variable to store data for class use
         self.__users = []
         self.__parsing_queue = queue.Queue()
+        self.__search_queue = queue.Queue()
         self.__last_search_data = None
+        self.__search_id = None
+        self.__search_request = None
+        # Next offset of every result type that has more results than were loaded
+        self.__search_more = {}
 
         # Fill the value from configs
         logger.info("Loading configurations..")
@@ -188,6 +208,21 @@ class MainWindow(QMainWindow):
         self.__media_parser_worker.progress.connect(self.__show_popup_dialog)
         self.__media_parser_worker.enqueue.connect(self.__add_item_to_downloads)
         self.__media_parser_thread.start()
+        logger.info("Preparing search worker")
+        self.__search_thread = QThread()
+        self.__search_worker = SearchWorker()
+        self.__search_worker.setup(self.__search_queue)
+        self.__search_worker.moveToThread(self.__search_thread)
+        self.__search_thread.started.connect(self.__search_worker.run)
+        self.__search_worker.finished.connect(self.__search_thread.quit)
+        self.__search_worker.finished.connect(self.__search_worker.deleteLater)
+        self.__search_thread.finished.connect(self.__search_thread.deleteLater)
+        self.__search_worker.results.connect(self.__add_search_results)
+        self.__search_worker.done.connect(self.__search_done)
+        self.__search_thread.start()
+        progress_aggregator.batch.connect(dl_progress_batch)
+        progress_aggregator.start()
+        threading.Thread(target=sweep_staging, name='staging-sweep', daemon=True).start()
 
         # Set application theme
         self.toggle_theme_button.clicked.connect(self.toggle_theme)
@@ -242,6 +277,7 @@ class MainWindow(QMainWindow):
         collapse_up_icon = QIcon(os.path.join(config.app_root, 'resources', 'icons', 'collapse_up.png'))
 
         self.btn_search.clicked.connect(self.__get_search_results)
+        self.btn_search_load_more.clicked.connect(self.__load_more_search_results)
 
         self.btn_login_add.clicked.connect(self.__add_account)
         self.btn_save_config.clicked.connect(self.__update_config)
@@ -1103,7 +1139,6 @@ class MainWindow(QMainWindow):
 
     def __get_search_results(self):
         search_term = self.inp_search_term.text().strip()
-        results = None
         if len(session_pool) <= 0:
             self.__splash_dialog.run(self.tr("You need to login to at least one account to use this feature."))
             return None
@@ -1122,42 +1157,56 @@ class MainWindow(QMainWindow):
                 self.inp_search_term.setText('')
                 return True
         logger.info(f"Search clicked with value term {search_term}")
-        try:
-            filters = []
-            if self.inp_enable_search_playlists.isChecked():
-                filters.append('playlist')
-            if self.inp_enable_search_albums.isChecked():
-                filters.append('album')
-            if self.inp_enable_search_tracks.isChecked():
-                filters.append('track')
-            if self.inp_enable_search_artists.isChecked():
-                filters.append('artist')
-            if self.inp_enable_search_shows.isChecked():
-                filters.append('show')
-            if self.inp_enable_search_episodes.isChecked():
-                filters.append('episode')
-            if self.inp_enable_search_audiobooks.isChecked():
-                filters.append('audiobook')
-            download = False
-            selected_uuid = fetch_account_uuid(download)
-            session = session_pool[ selected_uuid ]
-            try:
-                results = search_by_term(session, search_term,
-                                     config.get('max_search_results'), content_types=filters)
-            except (OSError, queue.Empty, MaxRetryError, NewConnectionError, ConnectionError):
-                # Internet disconnected ?
-                logger.error('Search failed Connection error ! Trying to re init parsing account session ! ')
-                re_init_session(session_pool, selected_uuid, wait_connectivity=False)
-                return None
-            self.__populate_search_results(results)
-            self.__last_search_data = results
-            self.inp_search_term.setText('')
-        except EmptySearchResultException:
-            self.__last_search_data = []
-            while self.tbl_search_results.rowCount() > 0:
-                self.tbl_search_results.removeRow(0)
+        filters = []
+        if self.inp_enable_search_playlists.isChecked():
+            filters.append('playlist')
+        if self.inp_enable_search_albums.isChecked():
+            filters.append('album')
+        if self.inp_enable_search_tracks.isChecked():
+            filters.append('track')
+        if self.inp_enable_search_artists.isChecked():
+            filters.append('artist')
+        if self.inp_enable_search_shows.isChecked():
+            filters.append('show')
+        if self.inp_enable_search_episodes.isChecked():
+            filters.append('episode')
+        if self.inp_enable_search_audiobooks.isChecked():
+            filters.append('audiobook')
+        # Results of an earlier search still in flight are dropped once the id changes
+        self.__search_id = str(uuid.uuid4())
+        self.__search_request = {'term': search_term, 'limit': config.get('max_search_results')}
+        self.__last_search_data = {c_type + 's': [] for c_type in filters}
+        self.__search_more = {}
+        self.btn_search_load_more.hide()
+        while self.tbl_search_results.rowCount() > 0:
+            self.tbl_search_results.removeRow(0)
+        self.__search_queue.put(dict(self.__search_request, id=self.__search_id, types=filters, offset=0))
+        self.inp_search_term.setText('')
+
+    def __load_more_search_results(self):
+        self.btn_search_load_more.hide()
+        types_by_offset = {}
+        for c_type, offset in self.__search_more.items():
+            types_by_offset.setdefault(offset, []).append(c_type)
+        self.__search_more = {}
+        for offset, types in types_by_offset.items():
+            self.__search_queue.put(dict(self.__search_request, id=self.__search_id, types=types, offset=offset))
+
+    def __add_search_results(self, search_id, c_type, items, next_offset, total):
+        if search_id != self.__search_id:
+            return
+        d_key = c_type + 's'
+        self.__last_search_data[d_key].extend(items)
+        self.__insert_search_items(d_key, items)
+        if next_offset < total:
+            self.__search_more[c_type] = next_offset
+
+    def __search_done(self, search_id, found):
+        if search_id != self.__search_id:
+            return
+        if not any(self.__last_search_data.values()):
             self.__splash_dialog.run(self.tr("No results found."))
-            return None
+        self.btn_search_load_more.setVisible(bool(self.__search_more))
 
     def __download_by_url(self, url=None, hide_dialog=False):
         logger.info(f"URL download clicked with value {url}")
@@ -1216,39 +1265,34 @@ class MainWindow(QMainWindow):
         tbl_search_results_headers.resizeSection(0, 450)
         return True
 
-    def __populate_search_results(self, data):
-        # Clear the table
-        self.__last_search_data = data
-        logger.debug('Populating search results table ')
-        while self.tbl_search_results.rowCount() > 0:
-            self.tbl_search_results.removeRow(0)
-        for d_key in data.keys():  # d_key in ['Albums', 'Artists', 'Tracks', 'Playlists', 'Shows', 'Episodes', 'Audiobooks']
-            for item in data[d_key]:  # Item is Data for Albums, Artists, etc.
-                # Set item name
-                item_name, item_by = name_by_from_sdata(d_key, item)
-                if item_name is None and item_by is None:
-                    continue
-                if d_key.lower() == "tracks":
-                    thumb_dict = item['album']['images']
-                # Playlists fail because height and width in the response are set to null
-                elif d_key.lower() == "playlists":
-                    url = item['images'][int('0')]['url']
-                    thumb_dict = [{'height': 64, 'url': url,'width': 64}]
-                else:
-                    thumb_dict = item['images']
-                queue_data = {'media_type': d_key[0:-1], 'media_id': item['id'],
-                              'data': {
-                                  'media_title': item_name.replace(config.get("explicit_label"), ""),
-                                  'thumb_url': get_thumbnail(thumb_dict,
-                                                             preferred_size=config.get('search_thumb_height')^2
-                                                             )
-                              }}
-                tmp_dl_val = self.inp_tmp_dl_root.text().strip()
-                if self.__advanced_visible and tmp_dl_val != "" and os.path.isdir(tmp_dl_val):
-                    queue_data['data']['dl_path'] = tmp_dl_val
-                btn_text = f"Download {d_key[0:-1]}".replace('artist', 'discography').title()
-                self.__insert_search_result_row(btn_text=btn_text, item_name=item_name, item_by=item_by,
-                                                item_type=d_key[0:-1].title(), queue_data=queue_data)
+    def __insert_search_items(self, d_key, items):
+        logger.debug(f'Adding {len(items)} {d_key} to search results table ')
+        for item in items:  # Item is Data for Albums, Artists, etc.
+            # Set item name
+            item_name, item_by = name_by_from_sdata(d_key, item)
+            if item_name is None and item_by is None:
+                continue
+            if d_key.lower() == "tracks":
+                thumb_dict = item['album']['images']
+            # Playlists fail because height and width in the response are set to null
+            elif d_key.lower() == "playlists":
+                url = item['images'][int('0')]['url']
+                thumb_dict = [{'height': 64, 'url': url,'width': 64}]
+            else:
+                thumb_dict = item['images']
+            queue_data = {'media_type': d_key[0:-1], 'media_id': item['id'],
+                          'data': {
+                              'media_title': item_name.replace(config.get("explicit_label"), ""),
+                              'thumb_url': get_thumbnail(thumb_dict,
+                                                         preferred_size=config.get('search_thumb_height')^2
+                                                         )
+                          }}
+            tmp_dl_val = self.inp_tmp_dl_root.text().strip()
+            if self.__advanced_visible and tmp_dl_val != "" and os.path.isdir(tmp_dl_val):
+                queue_data['data']['dl_path'] = tmp_dl_val
+            btn_text = f"Download {d_key[0:-1]}".replace('artist', 'discography').title()
+            self.__insert_search_result_row(btn_text=btn_text, item_name=item_name, item_by=item_by,
+                                            item_type=d_key[0:-1].title(), queue_data=queue_data)
 
     def __mass_action_dl(self, result_type):
         data = self.__last_search_data
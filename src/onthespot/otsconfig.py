@@ -57,21 +57,58 @@ class Config:
             "dl_end_padding_bytes": 167,
             "max_retries": 3, # Number of times to retry before giving up on download
             "max_search_results": 10, # Number of search results to display of each type
+            "progress_refresh_ms": 66, # Milliseconds between download progress bar refreshes
             "media_format": "mp3", # Song track media format
             "podcast_media_format": "mp3", # Podcast track media format
             "illegal_character_replacement": "-", # Character used to replace illegal characters or values in path
             "force_raw": False, # Skip media conversion and metadata writing
             "force_premium": False, # Set premium flag to always return true
-            "chunk_size": 50000, # Chunk size in bytes to download in
+            "chunk_size": 50000, # Chunk size in bytes to download in, the starting size when adaptive_chunk_size is on
+            "adaptive_chunk_size": True, # Grow or shrink chunks from the measured download speed
+            "chunk_size_min": 16384, # Smallest chunk in bytes read when adaptive_chunk_size is on
+            "chunk_size_max": 1048576, # Largest chunk in bytes read when adaptive_chunk_size is on
+            "chunk_target_latency": 0.2, # Seconds a single chunk read should take when adaptive_chunk_size is on
             "recoverable_fail_wait_delay": 10, # No of seconds to wait before failure that can be retried
+            "stream_conversion": False, # Pipe audio into ffmpeg while it downloads instead of converting the finished file
+            "transcode_workers": 0, # Number of files converted by ffmpeg at once, 0 for one per cpu core
+            "finalize_workers": 2, # Number of files tagged and moved into place at once
+            "postprocess_queue_size": 8, # Downloaded files waiting for each post processing step before downloads pause
+            "http_pool_maxsize": 10, # Maximum number of keep-alive connections per api host
+            "http_max_retries": 10, # Number of times to retry a failed connection to an api host
+            "http_connect_timeout": 10, # Seconds to wait for a connection to an api host
+            "http_read_timeout": 30, # Seconds to wait for a response from an api host
+            "http_cassette_mode": "", # Record api traffic to or replay it from http_cassette_dir, empty to disable
+            "http_cassette_dir": "", # Directory of recorded api traffic, defaults to the cache directory
+            "http_cassette_latency": 0, # Seconds of delay added to every replayed response
+            "api_rate_limit": 10, # Sustained api requests per second per account and host
+            "api_rate_burst": 20, # Api requests an account can make at once before being throttled
+            "api_max_attempts": 5, # Number of times to send an api request that was rate limited or failed server side
+            "api_backoff_base": 1, # Seconds to back off after the first failed api request, doubled every attempt
+            "api_max_retry_after": 120, # Give up instead of waiting when spotify asks for a longer cooldown
+            "token_refresh_margin": 300, # Seconds before expiry at which access tokens are refreshed in the background
+            "cache_max_size_mb": 256, # Maximum size of the metadata cache
+            "cache_default_ttl": 604800, # Seconds a cached api response stays valid when its endpoint has no ttl
+            "cache_revalidate_window": 2592000, # Seconds an expired response with an ETag is kept to be revalidated
+            "metadata_memory_cache_size": 512, # Number of album and artist objects kept in memory
+            "episode_store_size": 5000, # Number of episode objects kept in memory while shows are queued
             "disable_bulk_dl_notices": True, # Hide popups for bulk download buttons
             "save_album_cover": False, # Save album covers to a file
             "album_cover_format": "png", # Album cover format
+            "cover_cache_size": 32, # Number of downloaded covers kept in memory for the tracks of the same album
             "inp_enable_lyrics": False, # Enable lyrics download
             "use_lrc_file": False, # Download .lrc file alongside track
             "only_synced_lyrics": False, # Only use synced lyrics
+            "lyrics_workers": 2, # Number of lyrics fetched in the background while tracks are downloading
+            "lyrics_miss_ttl": 604800, # Seconds to remember that a track has no lyrics
             "use_playlist_path": False, # Use playlist path
             "create_m3u_playlists": False, # Create m3u based playlist
+            "incremental_playlist_sync": False, # Only queue tracks added to a playlist since it was last queued
+            "playlist_snapshot_ttl": 2592000, # Seconds the track list of a playlist snapshot is remembered
+            "concurrent_metadata": True, # Fetch the independent parts of a track's metadata in parallel
+            "metadata_workers": 8, # Maximum number of parallel metadata requests
+            "pagination_workers": 4, # Maximum number of pages of a playlist, album or show fetched in parallel
+            "prefetch_track_metadata": True, # Resolve track metadata in batches while parsing albums and playlists
+            "song_info_store_size": 5000, # Number of prefetched track metadata objects kept until their download starts
             "translate_file_path": False, # Translate downloaded file path to application language
             "ffmpeg_args": [], # Extra arguments for ffmpeg
             "show_search_thumbnails": True, # Show thumbnails in search view
@@ -1,8 +1,10 @@
+from collections import OrderedDict
 from queue import Empty, Queue
 from .otsconfig import config
 import sys
 import os
 import logging
+import threading
 from logging.handlers import RotatingFileHandler
 
 
@@ -25,6 +27,8 @@ failed_downloads = {}
 cancel_list = {}
 downloads_status = {}
 playlist_m3u_queue = {}
+# Held while an entry of playlist_m3u_queue is replaced or taken out
+playlist_m3u_lock = threading.Lock()
 downloaded_data = {}
 unavailable = set()
 
@@ -50,3 +54,36 @@ def handle_exception(exc_type, exc_value, exc_traceback):
 
 
 sys.excepthook = handle_exception
+
+
+class SongInfoStore:
+    # Prefetched track metadata waiting for its download. Once max_items is reached the oldest entries are
+    # dropped, those tracks are looked up again when their download starts.
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.__items = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__items
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__items)
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def update(self, items):
+        with self.__lock:
+            self.__items.update(items)
+            while len(self.__items) > self.max_items:
+                self.__items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.__lock:
+            return self.__items.pop(key, default)
+
+
+song_info_store = SongInfoStore(config.get('song_info_store_size'))
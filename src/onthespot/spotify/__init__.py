@@ -1,4 +1,4 @@
 from .media import MediaWatcher
 from .downloader import DownloadWorker
 from .session import LoadSessions
-from .utility import PlayListMaker, ParsingQueueProcessor
\ No newline at end of file
+from .utility import PlayListMaker, ParsingQueueProcessor, SearchWorker
\ No newline at end of file
@@ -1,31 +1,38 @@
-import base64
 import os
 import re
 import string
 import subprocess
+import threading
+import time
+from urllib.parse import urlsplit, parse_qsl
 from ..exceptions import *
-import requests.adapters
 from ..otsconfig import config
-import requests
 import json
 from mutagen import File
 from mutagen.easyid3 import EasyID3, ID3
-from mutagen.flac import Picture, FLAC
-from mutagen.id3 import APIC, TXXX, USLT, WOAS
-from mutagen.mp4 import MP4, MP4Cover
+from mutagen.flac import FLAC
+from mutagen.id3 import TXXX, USLT, WOAS
+from mutagen.mp4 import MP4
 from mutagen.oggvorbis import OggVorbis
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from PIL import Image
-from io import BytesIO
-from hashlib import md5
 from ..runtimedata import get_logger
+from .http_client import client
+from .ratelimit import scheduler
+from .tokens import get_token
+from .cache import cache, make_key, ttl_for, album_cache, artist_cache, episode_cache
+from .covers import cover_cache
+from .cassette import recording
 from librespot.audio.decoders import AudioQuality
 
 logger = get_logger("spotutils")
-requests.adapters.DEFAULT_RETRIES = 10
+metadata_executor = ThreadPoolExecutor(max_workers=config.get('metadata_workers'), thread_name_prefix='metadata')
+_stats_lock = threading.Lock()
+_logged_stats = None
 
 def play_media(session, media_id, media_type):
-    access_token = session.tokens().get("user-modify-playback-state")
+    access_token = get_token(session, "user-modify-playback-state")
     url = 'https://api.spotify.com/v1/me/player/play'
 
     payload = {
@@ -39,25 +46,25 @@ def play_media(session, media_id, media_type):
     'Authorization': f'Bearer {access_token}'
     }
 
-    resp = requests.put(url, headers=headers)
+    resp = client.put(url, headers=headers)
     logger.info(f"Playing item: {resp}")
 
 def queue_media(session, media_id, media_type):
-    access_token = session.tokens().get("user-modify-playback-state")
+    access_token = get_token(session, "user-modify-playback-state")
     url = f'https://api.spotify.com/v1/me/player/queue?uri=spotify%3A{media_type}%3A{media_id}'
     headers = {
     'Authorization': f'Bearer {access_token}'
     }
-    resp = requests.post(url, headers=headers)
+    resp = client.post(url, headers=headers)
     logger.info(f"Item Queued: {resp}")
 
 def check_if_media_in_library(session, media_id, media_type):
-    access_token = session.tokens().get("user-library-read")
+    access_token = get_token(session, "user-library-read")
     url = f'https://api.spotify.com/v1/me/{media_type}s/contains?ids={media_id}'
     headers = {
     'Authorization': f'Bearer {access_token}'
     }
-    resp = requests.get(url, headers=headers)
+    resp = client.get(url, headers=headers)
     logger.info(f"Checking if item is in library: {resp}")
     if resp.json() == [True]:
         return True
@@ -65,28 +72,28 @@ def check_if_media_in_library(session, media_id, media_type):
         return False
 
 def save_media_to_library(session, media_id, media_type):
-    access_token = session.tokens().get("user-library-modify")
+    access_token = get_token(session, "user-library-modify")
     url = f'https://api.spotify.com/v1/me/{media_type}s?ids={media_id}'
     headers = {
     'Authorization': f'Bearer {access_token}'
     }
-    resp = requests.put(url, headers=headers)
+    resp = client.put(url, headers=headers)
     logger.info(f"Item saved to library: {resp}")
 
 def remove_media_from_library(session, media_id, media_type):
     if media_type == 'track' or media_type == 'episode':
-        access_token = session.tokens().get("user-library-modify")
+        access_token = get_token(session, "user-library-modify")
         url = f'https://api.spotify.com/v1/me/{media_type}s?ids={media_id}'
         headers = {
         'Authorization': f'Bearer {access_token}'
         }
-        resp = requests.delete(url, headers=headers)
+        resp = client.delete(url, headers=headers)
         logger.info(f"Item removed from library: {resp}")
 
 def get_currently_playing_url(session):
     url = "https://api.spotify.com/v1/me/player/currently-playing"
-    access_token = session.tokens().get("user-read-currently-playing")
-    resp = requests.get(url, headers={"Authorization": "Bearer %s" % access_token})
+    access_token = get_token(session, "user-read-currently-playing")
+    resp = client.get(url, headers={"Authorization": "Bearer %s" % access_token})
     if resp.status_code == 200:
         return resp.json()['item']['external_urls']['spotify']
     else:
@@ -94,40 +101,106 @@ def get_currently_playing_url(session):
 
 def get_artist_albums(session, artist_id):
     logger.info(f"Get albums for artist by id '{artist_id}'")
-    access_token = session.tokens().get("user-read-email")
-    resp = make_call(f'https://api.spotify.com/v1/artists/{artist_id}/albums?include_groups=album%2Csingle%2Cappears_on%2Ccompilation&limit=50', token=access_token)
-    return [resp['items'][i]['id'] for i in range(len(resp['items']))]
+    access_token = get_token(session, "user-read-email")
+    album_ids = []
+    params = {'include_groups': 'album,single,appears_on,compilation'}
+    for resp in paginate(f'https://api.spotify.com/v1/artists/{artist_id}/albums', access_token, limit=50, params=params):
+        album_ids.extend(item['id'] for item in resp['items'])
+    return album_ids
+
+
+def get_artist_discography(session, artist_id):
+    # Returns [(album, tracks)] for every release, album headers come from the multi id endpoint which
+    # already carries the first 50 tracks of each album
+    access_token = get_token(session, "user-read-email")
+    album_ids = list(dict.fromkeys(get_artist_albums(session, artist_id)))
+    albums = get_albums_data(album_ids, access_token)
+    logger.info(f"Expanding discography of artist by id '{artist_id}', {len(albums)} releases")
+    return [(albums[album_id], get_album_tracks_from_data(albums[album_id], access_token))
+            for album_id in album_ids if album_id in albums]
 
 
 def get_playlist_data(session, playlist_id):
     logger.info(f"Get playlist dump for '{playlist_id}'")
-    access_token = session.tokens().get("user-read-email")
-    resp = make_call(f'https://api.spotify.com/v1/playlists/{playlist_id}', token=access_token, skip_cache=True)
-    return resp['name'], resp['owner']['display_name'], resp['description'], resp['external_urls']['spotify']
+    access_token = get_token(session, "user-read-email")
+    params = {'fields': 'name,owner(display_name),description,external_urls,snapshot_id'}
+    resp = make_call(f'https://api.spotify.com/v1/playlists/{playlist_id}', token=access_token, params=params,
+                     revalidate=True)
+    return resp['name'], resp['owner']['display_name'], resp['description'], resp['external_urls']['spotify'], resp['snapshot_id']
+
+
+def get_playlist_tracks_by_snapshot(session, playlist_id, snapshot_id):
+    # Returns (tracks, added, removed). The track list stored for an unchanged snapshot_id is reused without
+    # fetching any page, otherwise the pages are fetched and diffed against it. added is None on first sight.
+    snapshot_key = make_key(f'playlist-snapshot://{playlist_id}')
+    stored = cache.get(snapshot_key)
+    stored = json.loads(stored) if stored is not None else None
+    if stored is not None and stored['snapshot_id'] == snapshot_id:
+        logger.info(f"Playlist '{playlist_id}' unchanged since snapshot '{snapshot_id}'")
+        return stored['tracks'], [], []
+
+    tracks = []
+    for song in get_tracks_from_playlist(session, playlist_id):
+        track = song['track']
+        if track is None or track['id'] is None:
+            continue
+        tracks.append({
+            'id': track['id'],
+            'type': track.get('type', 'track'),
+            'name': track['name'],
+            'explicit': track.get('explicit', False),
+            'artists': [{'name': artist['name']} for artist in track.get('artists', [])]
+        })
+    cache.set(snapshot_key, f'playlist-snapshot://{playlist_id}',
+              json.dumps({'snapshot_id': snapshot_id, 'tracks': tracks}).encode(),
+              ttl=config.get('playlist_snapshot_ttl'))
+    if stored is None:
+        return tracks, None, []
+    previous_ids = {track['id'] for track in stored['tracks']}
+    current_ids = {track['id'] for track in tracks}
+    added = [track for track in tracks if track['id'] not in previous_ids]
+    removed = [track_id for track_id in previous_ids if track_id not in current_ids]
+    logger.info(f"Playlist '{playlist_id}' changed, {len(added)} tracks added, {len(removed)} removed")
+    return tracks, added, removed
+
+
+def get_playlist_paths(playlist_id):
+    # Returns {track_id: {'media_path', 'media_name'}} of the tracks in the m3u8 last written for the playlist
+    stored = cache.get(make_key(f'playlist-paths://{playlist_id}'))
+    return json.loads(stored) if stored is not None else {}
+
+
+def set_playlist_paths(playlist_id, entries):
+    # Remembered next to the snapshot, an incremental sync only queues new tracks but still lists every one
+    cache.set(make_key(f'playlist-paths://{playlist_id}'), f'playlist-paths://{playlist_id}',
+              json.dumps(entries).encode(), ttl=config.get('playlist_snapshot_ttl'))
+
+
+def get_lyrics_data(session, item_id, item_type):
+    if item_type == "track":
+        url = f'https://spclient.wg.spotify.com/color-lyrics/v2/track/{item_id}'
+    elif item_type == "episode":
+        url = f"https://spclient.wg.spotify.com/transcript-read-along/v2/episode/{item_id}"
 
+    token = get_token(session, "user-read-email")
+    params = 'format=json&market=from_token'
 
-def get_track_lyrics(session, item_id, item_type, metadata, forced_synced):
-    lyrics = []
-    try:
-        if item_type == "track":
-            url = f'https://spclient.wg.spotify.com/color-lyrics/v2/track/{item_id}'
-        elif item_type == "episode":
-            url = f"https://spclient.wg.spotify.com/transcript-read-along/v2/episode/{item_id}"
+    headers = {
+    'app-platform': 'WebPlayer',
+    'Authorization': f'Bearer {token}',
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/77.0.3865.90 Safari/537.36"
+    }
 
-        token = session.tokens().get("user-read-email")
-        params = 'format=json&market=from_token'
+    # Items without lyrics answer 404, remember that instead of asking again on every retry
+    return make_call(url, token, headers=headers, params=params, negative_ttl=config.get('lyrics_miss_ttl'))
 
-        headers = {
-        'app-platform': 'WebPlayer',
-        'Authorization': f'Bearer {token}',
-        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/77.0.3865.90 Safari/537.36"
-        }
-
-        resp = make_call(url, token, headers=headers, params=params)
-        if resp == None:
-            logger.info(f"Failed to find lyrics for {item_type}: {item_id}")
-            return None
 
+def format_lyrics(resp, item_id, item_type, metadata, forced_synced):
+    lyrics = []
+    if resp == None:
+        logger.info(f"Failed to find lyrics for {item_type}: {item_id}")
+        return None
+    try:
         if config.get("embed_branding"):
             lyrics.append('[re:OnTheSpot]')
 
@@ -194,23 +267,54 @@ def get_track_lyrics(session, item_id, item_type, metadata, forced_synced):
 def get_tracks_from_playlist(session, playlist_id):
     logger.info(f"Get tracks from playlist by id '{playlist_id}'")
     songs = []
-    access_token = session.tokens().get("user-read-email")
-    headers = {'Authorization': f'Bearer {access_token}'}
+    access_token = get_token(session, "user-read-email")
     url = f'https://api.spotify.com/v1/playlists/{playlist_id}/tracks?additional_types=episode'
-    while url:
-        resp = make_call(url, token=access_token, skip_cache=True)
+    for resp in paginate(url, access_token, limit=100, revalidate=True):
         songs.extend(resp['items'])
-        url = resp['next']
     return songs
 
 
+def get_album_data(album_id, token):
+    return album_cache.get_or_load(
+        album_id, lambda: make_call(f'https://api.spotify.com/v1/albums/{album_id}', token=token))
+
+
+def get_artist_data(artist_id, token):
+    return artist_cache.get_or_load(
+        artist_id, lambda: make_call(f'https://api.spotify.com/v1/artists/{artist_id}', token=token))
+
+
+def get_albums_data(album_ids, token):
+    albums = {album_id: album_cache.get(album_id) for album_id in album_ids}
+    missing = [album_id for album_id, album in albums.items() if album is None]
+    for batch in batched(missing, 20):
+        resp = make_call(f'https://api.spotify.com/v1/albums?ids={",".join(batch)}', token=token)
+        for album in resp['albums'] if resp else []:
+            if album is not None:
+                album_cache.put(album['id'], album)
+                albums[album['id']] = album
+    return {album_id: album for album_id, album in albums.items() if album is not None}
+
+
+def get_artists_data(artist_ids, token):
+    artists = {artist_id: artist_cache.get(artist_id) for artist_id in artist_ids}
+    missing = [artist_id for artist_id, artist in artists.items() if artist is None]
+    for batch in batched(missing, 50):
+        resp = make_call(f'https://api.spotify.com/v1/artists?ids={",".join(batch)}', token=token)
+        for artist in resp['artists'] if resp else []:
+            if artist is not None:
+                artist_cache.put(artist['id'], artist)
+                artists[artist['id']] = artist
+    return {artist_id: artist for artist_id, artist in artists.items() if artist is not None}
+
+
 def get_album_name(session, album_id):
     logger.info(f"Get album info from album by id ''{album_id}'")
-    access_token = session.tokens().get("user-read-email")
-    resp = make_call(
-        f'https://api.spotify.com/v1/albums/{album_id}',
-        token=access_token
-        )
+    access_token = get_token(session, "user-read-email")
+    return get_album_name_from_data(get_album_data(album_id, access_token))
+
+
+def get_album_name_from_data(resp):
     if m := re.search(r'(\d{4})', resp['release_date']):
         return resp['artists'][0]['name'],\
             m.group(1), resp['name'],\
@@ -223,75 +327,84 @@ def get_album_name(session, album_id):
 
 def get_album_tracks(session, album_id):
     logger.info(f"Get tracks from album by id '{album_id}'")
-    access_token = session.tokens().get("user-read-email")
-    songs = []
-    offset = 0
-    limit = 50
-    include_groups = 'album,compilation'
-
-    while True:
-        params = {
-            'limit': limit,
-            'include_groups': include_groups,
-            'offset': offset
-            }
-        resp = make_call(
-            f'https://api.spotify.com/v1/albums/{album_id}/tracks',
-            token=access_token,
-            params=params
-            )
-        offset += limit
-        songs.extend(resp['items'])
+    access_token = get_token(session, "user-read-email")
+    return get_album_tracks_from_data(get_album_data(album_id, access_token), access_token)
 
-        if len(resp['items']) < limit:
-            break
+
+def get_album_tracks_from_data(album, token):
+    # The album object holds the first page of tracks, only longer albums need more requests
+    songs = list(album['tracks']['items'])
+    if album['tracks']['total'] > len(songs):
+        for resp in paginate(f'https://api.spotify.com/v1/albums/{album["id"]}/tracks', token,
+                             limit=50, offset=len(songs)):
+            songs.extend(resp['items'])
     return songs
 
 
+def ffmpeg_command(source, filename, quality):
+    target_path = Path(filename)
+    bitrate = "320k" if quality == AudioQuality.VERY_HIGH else "160k"
+    # Prepare default parameters
+    command = [
+        config.get('_ffmpeg_bin_path'),
+        '-i', source
+    ]
+    # If the media format is set to ogg, just correct the downloaded file
+    # and add tags
+    if target_path.suffix == '.ogg':
+        command = command + ['-c', 'copy']
+    else:
+        command = command + ['-ar', '44100', '-ac', '2', '-b:a', bitrate]
+    if int(os.environ.get('SHOW_FFMPEG_OUTPUT', 0)) == 0:
+        command = command + \
+            ['-loglevel', 'error', '-hide_banner', '-nostats']
+    # Add user defined parameters
+    for param in config.get('ffmpeg_args'):
+        command.append(param)
+    # Add output parameter at last
+    command.append(
+            filename
+        )
+    return command
+
+
 def convert_audio_format(filename, quality):
     if os.path.isfile(os.path.abspath(filename)):
         target_path = Path(filename)
-        bitrate = "320k" if quality == AudioQuality.VERY_HIGH else "160k"
         temp_name = os.path.join(
             target_path.parent, ".~"+target_path.stem+".ogg"
             )
         if os.path.isfile(temp_name):
             os.remove(temp_name)
         os.rename(filename, temp_name)
-        # Prepare default parameters
-        command = [
-            config.get('_ffmpeg_bin_path'),
-            '-i', temp_name
-        ]
-        # If the media format is set to ogg, just correct the downloaded file
-        # and add tags
-        if target_path.suffix == '.ogg':
-            command = command + ['-c', 'copy']
-        else:
-            command = command + ['-ar', '44100', '-ac', '2', '-b:a', bitrate]
-        if int(os.environ.get('SHOW_FFMPEG_OUTPUT', 0)) == 0:
-            command = command + \
-                ['-loglevel', 'error', '-hide_banner', '-nostats']
-        # Add user defined parameters
-        for param in config.get('ffmpeg_args'):
-            command.append(param)
-        # Add output parameter at last
-        command.append(
-                filename
-            )
+        command = ffmpeg_command(temp_name, filename, quality)
         logger.info(
             f'Converting media with ffmpeg. Built commandline {command}'
             )
-        # Run subprocess with CREATE_NO_WINDOW flag on Windows
-        if os.name == 'nt':
-            subprocess.check_call(command, shell=False, creationflags=subprocess.CREATE_NO_WINDOW)
-        else:
-            subprocess.check_call(command, shell=False)
-        os.remove(temp_name)
+        try:
+            # Run subprocess with CREATE_NO_WINDOW flag on Windows
+            if os.name == 'nt':
+                subprocess.check_call(command, shell=False, creationflags=subprocess.CREATE_NO_WINDOW)
+            else:
+                subprocess.check_call(command, shell=False)
+        finally:
+            os.remove(temp_name)
     else:
         raise FileNotFoundError
 
 
+def open_audio_encoder(filename, quality):
+    # Encodes whatever is written to stdin into filename, the stream is converted while it downloads.
+    # stdin is unbuffered so closing it after the encoder was killed never has data left to flush.
+    command = ffmpeg_command('pipe:0', filename, quality)
+    command.insert(1, '-y')
+    logger.info(f'Streaming media into ffmpeg. Built commandline {command}')
+    if os.name == 'nt':
+        return subprocess.Popen(command, shell=False, stdin=subprocess.PIPE, bufsize=0,
+                                creationflags=subprocess.CREATE_NO_WINDOW)
+    return subprocess.Popen(command, shell=False, stdin=subprocess.PIPE, bufsize=0)
+
+
 def conv_list_format(items):
     formatted = ""
     for item in items:
@@ -513,71 +626,62 @@ def set_audio_tags(filename, metadata, track_id_str):
     tags.save()
 
 
-def set_music_thumbnail(filename, image_url):
+def set_music_thumbnail(filename, image_url, cover_dir=None):
     filetype = Path(filename).suffix
+    cover_format = config.get("album_cover_format")
+    if not config.get("embed_cover") and not config.get("save_album_cover"):
+        return
+    cover = cover_cache.get(image_url)
     if config.get("embed_cover"):
         logger.info(f"Set thumbnail for audio media at '{filename}' with '{image_url}'")
-        img = Image.open(BytesIO(requests.get(image_url).content))
-        buf = BytesIO()
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        img.save(buf, format=config.get("album_cover_format"))
-        buf.seek(0)
         if filetype == '.mp3':
             tags = ID3(filename)
-            tags['APIC'] = APIC(
-                              encoding=3,
-                              mime=f'image/{config.get("album_cover_format")}',
-                              type=3, desc=u'Cover',
-                              data=buf.read()
-                            )
+            tags['APIC'] = cover.apic(cover_format)
         elif filetype == '.flac':
             tags = FLAC(filename)
-            picture = Picture()
-            picture.data = buf.read()
-            picture.type = 3
-            picture.desc = "Cover"
-            picture.mime = f"image/{config.get('album_cover_format')}"
-            picture_data = picture.write()
-            encoded_data = base64.b64encode(picture_data)
-            vcomment_value = encoded_data.decode("ascii")
-            tags["metadata_block_picture"] = [vcomment_value]
+            tags["metadata_block_picture"] = [cover.vorbis_picture(cover_format)]
         elif filetype == '.ogg':
             tags = OggVorbis(filename)
-            picture = Picture()
-            picture.data = buf.read()
-            picture.type = 3
-            picture.desc = "Cover"
-            picture.mime = f"image/{config.get('album_cover_format')}"
-            picture_data = picture.write()
-            encoded_data = base64.b64encode(picture_data)
-            vcomment_value = encoded_data.decode("ascii")
-            tags["metadata_block_picture"] = [vcomment_value]
+            tags["metadata_block_picture"] = [cover.vorbis_picture(cover_format)]
         elif filetype == '.m4a':
             tags = MP4(filename)
-            tags['covr'] = [MP4Cover(data=buf.read())]
+            tags['covr'] = [cover.mp4_cover(cover_format)]
         else:
             logger.info(f"Unsupported media type: {filetype}")
         tags.save()
     if config.get("save_album_cover"):
-        cover_path = os.path.join(
-            Path(filename).parent, 'cover' + "." + config.get('album_cover_format'))
-        if not os.path.exists(cover_path):
-            img.save(cover_path)
+        cover_cache.save(cover, cover_dir or Path(filename).parent, cover_format)
+
+SEARCH_TYPES = ["track", "album", "playlist", "artist", "show", "episode", "audiobook"]
+
+
+def search_by_type(session, search_term, c_type, limit, offset=0):
+    # One page of a single result type, cached per (term, type, limit, offset) for a few minutes. Returns the
+    # items, the total and the offset of the next page, which counts the null padding filtered out of items.
+    token = get_token(session, "user-read-email")
+    resp = make_call(
+        "https://api.spotify.com/v1/search",
+        token=token,
+        params={
+            "limit": limit,
+            "offset": offset,
+            "q": search_term,
+            "type": c_type
+        }
+    )
+    if resp is None:
+        return [], 0, offset
+    page = resp[c_type + "s"]
+    # Spotify pads some result pages with nulls
+    return [item for item in page["items"] if item is not None], page["total"], offset + len(page["items"])
+
 
 def search_by_term(session,
                    search_term,
                    max_results=20,
-                   content_types=None) -> dict:
-    results: dict = {
-        "tracks": [],
-        "albums": [],
-        "playlists": [],
-        "artists": [],
-        "shows": [],
-        "episodes": [],
-        "audiobooks": [],
-    }
+                   content_types=None,
+                   offset=0) -> dict:
+    results: dict = {c_type + "s": [] for c_type in SEARCH_TYPES}
     logger.info(
         f"Get search result for term '{search_term}', max items '{max_results}'"
         )
@@ -585,21 +689,12 @@ def search_by_term(session,
         logger.warning(f"Returning empty data as query is empty !")
         return results
     if content_types is None:
-        content_types = ["track", "album", "playlist", "artist", "show", "episode", "audiobook"]
-    token = session.tokens().get("user-read-email")
-    resp = requests.get(
-        "https://api.spotify.com/v1/search",
-        {
-            "limit": max_results,
-            "offset": "0",
-            "q": search_term,
-            "type": ",".join(c_type for c_type in content_types)
-        },
-        headers={"Authorization": "Bearer %s" % token},
-    )
-    for c_type in content_types:
-        results[c_type + "s"] = resp.json()[c_type + "s"]["items"]
-    if len(results["tracks"]) + len(results["albums"]) + len(results["artists"]) + len(results["playlists"]) + len(results["shows"]) + len(results["episodes"]) + len(results["audiobooks"]) == 0:
+        content_types = SEARCH_TYPES
+    futures = {c_type: metadata_executor.submit(search_by_type, session, search_term, c_type, max_results, offset)
+               for c_type in content_types}
+    for c_type, future in futures.items():
+        results[c_type + "s"] = future.result()[0]
+    if sum(len(items) for items in results.values()) == 0:
         logger.warning(f"No results for term '{search_term}', max items '{max_results}'")
         raise EmptySearchResultException("No result found for search term '{}' ".format(search_term))
     else:
@@ -612,21 +707,144 @@ def check_premium(session):
         )
 
 
+AUDIO_FEATURE_TAGS = ['embed_bpm', 'embed_key', 'embed_timesignature', 'embed_acousticness', 'embed_danceability',
+                      'embed_energy', 'embed_instrumentalness', 'embed_liveness', 'embed_loudness',
+                      'embed_speechiness', 'embed_valence']
+_metadata_plan = (None, None)
+
+
+def get_metadata_plan():
+    # Work out which of the optional metadata endpoints the active config will actually use
+    global _metadata_plan
+    formatters = [config.get('track_path_formatter')]
+    if config.get('use_playlist_path'):
+        formatters.append(config.get('playlist_path_formatter'))
+    tag_keys = ['embed_performers', 'embed_producers', 'embed_writers', 'embed_discnumber', 'embed_label',
+                'embed_copyright', 'embed_genre'] + AUDIO_FEATURE_TAGS
+    signature = (config.get('force_raw'), tuple(formatters), tuple(config.get(key) for key in tag_keys))
+    if _metadata_plan[0] == signature:
+        return _metadata_plan[1]
+
+    placeholders = set()
+    for formatter in formatters:
+        placeholders.update(field for _, field, _, _ in string.Formatter().parse(formatter) if field)
+    tagging = not config.get('force_raw')
+    plan = {
+        'credits': tagging and any(config.get(key) for key in ['embed_performers', 'embed_producers', 'embed_writers']),
+        'audio_features': tagging and any(config.get(key) for key in AUDIO_FEATURE_TAGS),
+        'album': bool(placeholders & {'label', 'disccount'}) or
+            (tagging and any(config.get(key) for key in ['embed_discnumber', 'embed_label', 'embed_copyright'])),
+        'artist': 'genre' in placeholders or (tagging and config.get('embed_genre')),
+    }
+    logger.info(f'Metadata plan compiled: {plan}')
+    _metadata_plan = (signature, plan)
+    return plan
+
+
+def skipped_credits():
+    return {'roleCredits': [{'roleTitle': role, 'artists': []} for role in ['Performers', 'Producers', 'Writers']]}
+
+
+def skipped_album(track):
+    # The simplified album on the track already carries album_type and artists
+    return dict(track['album'], label='', copyrights=[])
+
+
+def skipped_artist():
+    return {'genres': []}
+
+
 def get_song_info(session, song_id):
-    token = session.tokens().get("user-read-email")
-    track_data = make_call(f'https://api.spotify.com/v1/tracks?ids={song_id}&market=from_token', token=token)
-    credits_data = make_call(f'https://spclient.wg.spotify.com/track-credits-view/v0/experimental/{song_id}/credits', token=token)
-    track_audio_data = make_call(f'https://api.spotify.com/v1/audio-features/{song_id}', token=token)
-    album_data = make_call(track_data['tracks'][0]['album']['href'], token=token)
-    artist_data = make_call(track_data['tracks'][0]['artists'][0]['href'], token=token)
+    token = get_token(session, "user-read-email")
+    plan = get_metadata_plan()
+    track_url = f'https://api.spotify.com/v1/tracks?ids={song_id}&market=from_token'
+    credits_url = f'https://spclient.wg.spotify.com/track-credits-view/v0/experimental/{song_id}/credits'
+    audio_url = f'https://api.spotify.com/v1/audio-features/{song_id}'
+    if config.get('concurrent_metadata'):
+        # Credits and audio features only need the id, album and artist need the track response
+        track_future = metadata_executor.submit(make_call, track_url, token=token)
+        credits_future = metadata_executor.submit(make_call, credits_url, token=token) if plan['credits'] else None
+        audio_future = metadata_executor.submit(make_call, audio_url, token=token) if plan['audio_features'] else None
+        track_data = track_future.result()
+        track = track_data['tracks'][0]
+        album_future = metadata_executor.submit(get_album_data, track['album']['id'], token) if plan['album'] else None
+        artist_future = metadata_executor.submit(get_artist_data, track['artists'][0]['id'], token) if plan['artist'] else None
+        credits_data = credits_future.result() if credits_future else skipped_credits()
+        track_audio_data = audio_future.result() if audio_future else None
+        album_data = album_future.result() if album_future else skipped_album(track)
+        artist_data = artist_future.result() if artist_future else skipped_artist()
+    else:
+        track_data = make_call(track_url, token=token)
+        track = track_data['tracks'][0]
+        credits_data = make_call(credits_url, token=token) if plan['credits'] else skipped_credits()
+        track_audio_data = make_call(audio_url, token=token) if plan['audio_features'] else None
+        album_data = get_album_data(track['album']['id'], token) if plan['album'] else skipped_album(track)
+        artist_data = get_artist_data(track['artists'][0]['id'], token) if plan['artist'] else skipped_artist()
+    return build_song_info(track, credits_data, track_audio_data, album_data, artist_data)
+
+
+def get_song_info_many(session, song_ids):
+    # Resolves many tracks through the multi id endpoints, returns {song_id: info} for every id found
+    token = get_token(session, "user-read-email")
+    plan = get_metadata_plan()
+    song_ids = list(dict.fromkeys(song_ids))
+    logger.info(f"Get song info for {len(song_ids)} tracks")
+
+    tracks = {}
+    for batch in batched(song_ids, 50):
+        resp = make_call(f'https://api.spotify.com/v1/tracks?ids={",".join(batch)}&market=from_token', token=token)
+        for song_id, track in zip(batch, resp['tracks'] if resp else []):
+            if track is not None:
+                tracks[song_id] = track
+
+    audio_features = {}
+    for batch in batched(list(tracks) if plan['audio_features'] else [], 100):
+        resp = make_call(f'https://api.spotify.com/v1/audio-features?ids={",".join(batch)}', token=token)
+        for song_id, features in zip(batch, resp['audio_features'] if resp else []):
+            audio_features[song_id] = features
+
+    albums = {}
+    if plan['album']:
+        album_ids = list(dict.fromkeys(track['album']['id'] for track in tracks.values()))
+        albums = get_albums_data(album_ids, token)
+
+    artists = {}
+    if plan['artist']:
+        artist_ids = list(dict.fromkeys(track['artists'][0]['id'] for track in tracks.values()))
+        artists = get_artists_data(artist_ids, token)
+
+    credits = {}
+    if plan['credits']:
+        # Credits have no multi id endpoint, fetch them side by side instead of one after another
+        futures = {song_id: metadata_executor.submit(
+            make_call, f'https://spclient.wg.spotify.com/track-credits-view/v0/experimental/{song_id}/credits',
+            token=token) for song_id in tracks}
+        credits = {song_id: future.result() for song_id, future in futures.items()}
+
+    infos = {}
+    for song_id, track in tracks.items():
+        credits_data = credits.get(song_id) if plan['credits'] else skipped_credits()
+        album_data = albums.get(track['album']['id']) if plan['album'] else skipped_album(track)
+        artist_data = artists.get(track['artists'][0]['id']) if plan['artist'] else skipped_artist()
+        if credits_data is None or album_data is None or artist_data is None:
+            logger.info(f"Batched song info incomplete for track by id '{song_id}', skipping")
+            continue
+        try:
+            infos[song_id] = build_song_info(track, credits_data, audio_features.get(song_id), album_data, artist_data)
+        except (AttributeError, KeyError):
+            # Leave it to get_song_info, which surfaces the failure for this track alone
+            logger.info(f"Batched song info incomplete for track by id '{song_id}', skipping")
+    return infos
+
 
+def build_song_info(track, credits_data, track_audio_data, album_data, artist_data):
     info = {}
 
     # Add Default Track Keys
     try:
         # Format Artists
         artists = []
-        for data in track_data['tracks'][0]['artists']:
+        for data in track['artists']:
             artists.append(data['name'])
 
         # Format Credits
@@ -640,15 +858,15 @@ def get_song_info(session, song_id):
                 ]
 
         info['artists'] = artists
-        info['album_name'] = track_data['tracks'][0]['album']["name"]
+        info['album_name'] = track['album']["name"]
         info['album_type'] = album_data['album_type']
         info['album_artists'] = album_data['artists'][0]['name']
-        info['name'] = track_data['tracks'][0]['name']
-        info['image_url'] = get_thumbnail(track_data['tracks'][0]['album']['images'], preferred_size=640000)
-        info['release_year'] = track_data['tracks'][0]['album']['release_date'].split("-")[0]
-        info['track_number'] = track_data['tracks'][0]['track_number']
-        info['total_tracks'] = track_data['tracks'][0]['album']['total_tracks']
-        info['disc_number'] = track_data['tracks'][0]['disc_number']
+        info['name'] = track['name']
+        info['image_url'] = get_thumbnail(track['album']['images'], preferred_size=640000)
+        info['release_year'] = track['album']['release_date'].split("-")[0]
+        info['track_number'] = track['track_number']
+        info['total_tracks'] = track['album']['total_tracks']
+        info['disc_number'] = track['disc_number']
         info['total_discs'] = sorted([trk['disc_number'] for trk in album_data['tracks']['items']])[-1] if 'tracks' in album_data else 1
         # https://developer.spotify.com/documentation/web-api/reference/get-track
         # List of genre is supposed to be here, genre from album API is deprecated and it always seems to be unavailable
@@ -659,12 +877,12 @@ def get_song_info(session, song_id):
         info['writers'] = [item for item in credits['writers'] if isinstance(item, str)]
         info['label'] = album_data['label']
         info['copyright'] = [holder['text'] for holder in album_data['copyrights']]
-        info['explicit'] = track_data['tracks'][0]['explicit']
-        info['isrc'] = track_data['tracks'][0]['external_ids'].get('isrc', '')
-        info['length'] = track_data['tracks'][0]['duration_ms']
-        info['popularity'] = track_data['tracks'][0]['popularity'] # unused
-        info['scraped_song_id'] = track_data['tracks'][0]['id']
-        info['is_playable'] = track_data['tracks'][0]['is_playable']
+        info['explicit'] = track['explicit']
+        info['isrc'] = track['external_ids'].get('isrc', '')
+        info['length'] = track['duration_ms']
+        info['popularity'] = track['popularity'] # unused
+        info['scraped_song_id'] = track['id']
+        info['is_playable'] = track['is_playable']
     except TypeError:
         logger.info('Caught a TypeError: Something went wrong in the default track keys, please file a bug report.')
 
@@ -717,34 +935,93 @@ def get_song_info(session, song_id):
 
 def get_episode_info(session, episode_id_str):
     logger.info(f"Get episode info for episode by id '{episode_id_str}'")
-    token = session.tokens().get("user-read-email")
-    info = make_call("https://api.spotify.com/v1/episodes/" + episode_id_str, token=token)
-    if "error" in info:
-        return None, None, None
+    token = get_token(session, "user-read-email")
+    info = episode_cache.get_or_load(
+        episode_id_str, lambda: make_call("https://api.spotify.com/v1/episodes/" + episode_id_str, token=token))
+    if info is None or "error" in info:
+        return (None,) * 10
     else:
-        return info["show"]["name"], info["name"], get_thumbnail(info['images']), info['release_date'], info['show']['total_episodes'], info['show']['publisher'], info['language'] if info['language'] != "" else info['show']['languages'][0], info['description'] if info['description'] != "" else info['show']['description'], info['show']['copyrights'], info['duration_ms']
+        return info["show"]["name"], info["name"], get_thumbnail(info['images']), info['release_date'], info['show']['total_episodes'], info['show']['publisher'], info.get('language', '') if info.get('language', '') != "" else info['show']['languages'][0], info['description'] if info['description'] != "" else info['show']['description'], info['show']['copyrights'], info['duration_ms']
+
+
+def get_episodes_data(session, episode_ids):
+    # Batch resolves the episodes the store does not hold yet, 50 ids per request
+    missing = [episode_id for episode_id in dict.fromkeys(episode_ids) if episode_cache.get(episode_id) is None]
+    if not missing:
+        return
+    token = get_token(session, "user-read-email")
+    for batch in batched(missing, 50):
+        resp = make_call(f'https://api.spotify.com/v1/episodes?ids={",".join(batch)}', token=token)
+        for episode in resp['episodes'] if resp else []:
+            if episode is not None:
+                episode_cache.put(episode['id'], episode)
 
 
 def get_show_episodes(session, show_id_str):
+    # The episode objects of the show listing fill the episode store, so get_episode_info needs no requests
     logger.info(f"Get episodes for show by id '{show_id_str}'")
-    access_token = session.tokens().get("user-read-email")
+    access_token = get_token(session, "user-read-email")
+    show = make_call(f'https://api.spotify.com/v1/shows/{show_id_str}', token=access_token)
+    show_header = {key: value for key, value in show.items() if key != 'episodes'}
+    items = list(show['episodes']['items'])
+    if show['episodes']['total'] > len(items):
+        for resp in paginate(f'https://api.spotify.com/v1/shows/{show_id_str}/episodes', access_token,
+                             limit=50, offset=len(items)):
+            items.extend(resp['items'])
     episodes = []
-    offset = 0
-    limit = 50
-    while True:
-        headers = {'Authorization': f'Bearer {access_token}'}
-        params = {'limit': limit, 'offset': offset}
-        resp = make_call(f'https://api.spotify.com/v1/shows/{show_id_str}/episodes', token=access_token, params=params)
-        offset += limit
-        for episode in resp["items"]:
-            episodes.append(episode["id"])
-
-        if len(resp['items']) < limit:
-            break
-
+    for episode in items:
+        if episode is None:
+            continue
+        episode_cache.put(episode['id'], dict(episode, show=show_header))
+        episodes.append(episode["id"])
+    if len(episodes) < len(items):
+        logger.warning(f"Show '{show_id_str}' listed {len(items) - len(episodes)} episodes without any data, "
+                       f"they can not be queued")
     return episodes
 
 
+def paginate(url, token, limit, params=None, skip_cache=False, offset=0, revalidate=False):
+    # Reads 'total' from the first page then fetches the remaining offsets in parallel, pages are
+    # yielded in their original order as soon as each one is available
+    params = dict(params or {})
+    first = make_call(url, token=token, params=dict(params, limit=limit, offset=offset), skip_cache=skip_cache,
+                      revalidate=revalidate)
+    yield first
+    if first is None:
+        return
+    if 'total' not in first:
+        # Not an offset based paging object, fall back to following 'next'
+        next_url = first.get('next')
+        while next_url:
+            resp = make_call(next_url, token=token, skip_cache=skip_cache, revalidate=revalidate)
+            yield resp
+            next_url = resp['next'] if resp else None
+        return
+    offsets = iter(range(offset + limit, first['total'], limit))
+    window = deque()
+    try:
+        while True:
+            # Keep at most pagination_workers pages in flight so other metadata calls are not starved
+            while len(window) < config.get('pagination_workers'):
+                page_offset = next(offsets, None)
+                if page_offset is None:
+                    break
+                window.append(metadata_executor.submit(
+                    make_call, url, token=token, params=dict(params, limit=limit, offset=page_offset),
+                    skip_cache=skip_cache, revalidate=revalidate))
+            if not window:
+                return
+            yield window.popleft().result()
+    finally:
+        for future in window:
+            future.cancel()
+
+
+def batched(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 def get_thumbnail(image_dict, preferred_size=22500):
     images = {}
     for image in image_dict:
@@ -759,28 +1036,108 @@ def get_thumbnail(image_dict, preferred_size=22500):
             return images[size]
     return images[available_sizes[-1]] if len(available_sizes) > 0 else ""
 
-def make_call(url, token, params=None, headers=None, skip_cache=False):
+# Default query parameters per url path, first match wins. market=from_token drops the available_markets arrays
+# that make up most of a track or album object, fields= trims playlist pages to what parsing reads
+ENDPOINT_PROFILES = [
+    (re.compile(r'^/v1/playlists/[^/]+/tracks$'),
+     {'market': 'from_token', 'fields': 'total,next,items(track(id,name,explicit,type,artists(name)))'}),
+    (re.compile(r'^/v1/(albums|shows|episodes|search)\b'), {'market': 'from_token'}),
+]
+
+
+def endpoint_params(url, params):
+    parts = urlsplit(url)
+    for pattern, defaults in ENDPOINT_PROFILES:
+        if pattern.search(parts.path):
+            # 'next' urls already carry the profile in their query string
+            present = {key for key, _ in parse_qsl(parts.query)}
+            return dict({k: v for k, v in defaults.items() if k not in present}, **params)
+    return params
+
+
+def make_call(url, token, params=None, headers=None, skip_cache=False, revalidate=False, negative_ttl=None):
+    # revalidate always asks the server, but with the stored validators so an unchanged resource costs a 304,
+    # negative_ttl caches a 404 as None for that many seconds
     if params is None:
         params = {}
+    if isinstance(params, dict):
+        params = endpoint_params(url, params)
     if headers is None:
         headers = {"Authorization": f"Bearer {token}"}
+    if recording():
+        # Cached responses never reach the http client, a recording made on a warm cache would miss them on replay
+        skip_cache = True
     if not skip_cache:
-        request_key = md5(f'{url}'.encode()).hexdigest()
-        req_cache_file = os.path.join(config.get('_cache_dir'), 'reqcache', request_key+'.otcache')
-        os.makedirs(os.path.dirname(req_cache_file), exist_ok=True)
-        if os.path.isfile(req_cache_file):
+        request_key = make_key(url, params)
+        entry = cache.lookup(request_key)
+        if entry is not None and not revalidate and entry['expires'] >= time.time():
             logger.debug(f'URL "{url}" cache found ! HASH: {request_key}')
             try:
-                with open(req_cache_file, 'r', encoding='utf-8') as cf:
-                    json_data = json.load(cf)
-                return json_data
+                return json.loads(entry['body'])
             except json.JSONDecodeError:
                 logger.error(f'URL "{url}" cache has invalid data, retring request !')
-                pass
-        logger.debug(f'URL "{url}" has cache miss ! HASH: {request_key}; Fetching data')
-    response = requests.get(url, headers=headers, params=params)
+                entry = None
+        if entry is not None:
+            headers = dict(headers)
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+            logger.debug(f'URL "{url}" revalidating cache ! HASH: {request_key}')
+        else:
+            logger.debug(f'URL "{url}" has cache miss ! HASH: {request_key}; Fetching data')
+    response = client.get(url, headers=headers, params=params)
+    if response.status_code == 304 and not skip_cache and entry is not None:
+        logger.debug(f'URL "{url}" not modified ! HASH: {request_key}')
+        cache.refresh(request_key, ttl_for(url))
+        return json.loads(entry['body'])
     if response.status_code == 200:
         if not skip_cache:
-            with open(req_cache_file, 'w', encoding='utf-8') as cf:
-                cf.write(response.text)
-        return json.loads(response.text)
+            cache.set(request_key, url, response.content, etag=response.headers.get('ETag'),
+                      last_modified=response.headers.get('Last-Modified'))
+        # Parsed from the raw bytes, response.text would run charset detection and copy the body
+        return json.loads(response.content)
+    if response.status_code == 404 and not skip_cache and negative_ttl:
+        cache.set(request_key, url, b'null', ttl=negative_ttl)
+
+
+def warm_cache(session, urls):
+    token = get_token(session, "user-read-email")
+    cached = 0
+    for url in urls:
+        if make_call(url, token=token) is not None:
+            cached += 1
+    return cached
+
+
+def network_stats():
+    # Request budget, retries, connection reuse and hit rates of the in memory caches
+    return {
+        'scheduler': scheduler.stats(),
+        'http': client.stats(),
+        'memory_caches': {
+            'album': album_cache.stats(),
+            'artist': artist_cache.stats(),
+            'episode': episode_cache.stats(),
+            'cover': cover_cache.stats(),
+        },
+    }
+
+
+def log_network_stats():
+    # Called by every download worker that finds the queue empty, only the first one with new numbers logs them
+    global _logged_stats
+    stats = network_stats()
+    summary = dict(stats, scheduler={key: value for key, value in stats['scheduler'].items() if key != 'buckets'})
+    with _stats_lock:
+        if summary == _logged_stats:
+            return
+        _logged_stats = summary
+    scheduler_stats = summary['scheduler']
+    logger.info(f"Api budget: waited {scheduler_stats['waited']}s, {scheduler_stats['throttled']} throttled, "
+                f"{scheduler_stats['retried']} retried, {len(stats['scheduler']['buckets'])} active buckets")
+    for host, host_stats in summary['http'].items():
+        logger.info(f"Http pool {host}: {host_stats['requests']} requests over {host_stats['connections']} "
+                    f"connections, {host_stats['reused']} reused")
+    logger.info('Memory caches: ' + ', '.join(f"{name} {cache_stats['hits']} hits/{cache_stats['misses']} misses"
+                                              for name, cache_stats in summary['memory_caches'].items()))
@@ -0,0 +1,272 @@
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from ..otsconfig import config
+from ..runtimedata import get_logger
+
+logger = get_logger("spotify.cache")
+
+# Seconds a cached response stays fresh, first matching url path pattern wins
+ENDPOINT_TTLS = [
+    (re.compile(r'^/v1/audio-features'), 90 * 86400),
+    (re.compile(r'^/v1/tracks'), 30 * 86400),
+    (re.compile(r'/credits$'), 30 * 86400),
+    (re.compile(r'^/color-lyrics/|^/transcript-read-along/'), 30 * 86400),
+    (re.compile(r'^/v1/albums'), 7 * 86400),
+    (re.compile(r'^/v1/episodes'), 7 * 86400),
+    (re.compile(r'^/v1/artists/[^/]+/albums'), 86400),
+    (re.compile(r'^/v1/artists'), 7 * 86400),
+    (re.compile(r'^/v1/shows'), 86400),
+    (re.compile(r'^/v1/playlists'), 3600),
+    (re.compile(r'^/v1/search'), 600),
+]
+# Refresh the LRU timestamp of an entry at most this often, so hits stay read only
+_TOUCH_INTERVAL = 300
+# Check the size cap after this many inserts
+_PRUNE_INTERVAL = 500
+
+
+def make_key(url, params=None):
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    if isinstance(params, dict):
+        query.extend((str(k), str(v)) for k, v in params.items())
+    elif params:
+        query.extend(parse_qsl(str(params), keep_blank_values=True))
+    market = ''
+    canonical = []
+    for k, v in sorted(query):
+        if k == 'market':
+            market = v
+        else:
+            canonical.append((k, v))
+    raw = f'{parts.netloc}{parts.path}?{urlencode(canonical)}|market={market}'
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def ttl_for(url):
+    path = urlsplit(url).path
+    for pattern, ttl in ENDPOINT_TTLS:
+        if pattern.search(path):
+            return ttl
+    return config.get('cache_default_ttl')
+
+
+class CacheStore:
+    def __init__(self, path=None):
+        self.path = path or os.path.join(config.get('_cache_dir'), 'metadata.db')
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__initialised = False
+        self.__writes = 0
+
+    def __conn(self):
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.__local.conn = conn
+            with self.__lock:
+                if not self.__initialised:
+                    self.__setup(conn)
+                    self.__initialised = True
+        return conn
+
+    def __setup(self, conn):
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'key TEXT PRIMARY KEY, url TEXT NOT NULL, body BLOB NOT NULL, size INTEGER NOT NULL, '
+                'created REAL NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)'
+            )
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(entries)')]
+            for column in ['etag', 'last_modified']:
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE entries ADD COLUMN {column} TEXT')
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)')
+        # Responses used to be stored as one file per url, those are never read again
+        legacy_dir = os.path.join(os.path.dirname(self.path), 'reqcache')
+        if os.path.isdir(legacy_dir):
+            logger.info(f'Removing legacy request cache at "{legacy_dir}"')
+            shutil.rmtree(legacy_dir, ignore_errors=True)
+
+    def get(self, key):
+        entry = self.lookup(key)
+        if entry is None or entry['expires'] < time.time():
+            return None
+        return entry['body']
+
+    def lookup(self, key):
+        # Returns the entry even when it has expired, along with the validators to revalidate it
+        conn = self.__conn()
+        row = conn.execute('SELECT body, expires, accessed, etag, last_modified FROM entries WHERE key = ?',
+                           (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if row[1] < now and row[3] is None and row[4] is None:
+            return None
+        if now - row[2] > _TOUCH_INTERVAL:
+            try:
+                with conn:
+                    conn.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+            except sqlite3.OperationalError:
+                # Another process holds the write lock, the LRU position can wait
+                pass
+        try:
+            body = zlib.decompress(row[0])
+        except zlib.error:
+            logger.error(f'Cache entry {key} is corrupt, dropping it')
+            self.delete(key)
+            return None
+        return {'body': body, 'expires': row[1], 'etag': row[3], 'last_modified': row[4]}
+
+    def set(self, key, url, body, ttl=None, etag=None, last_modified=None):
+        if ttl is None:
+            ttl = ttl_for(url)
+        if ttl <= 0 and etag is None and last_modified is None:
+            return
+        data = zlib.compress(body)
+        now = time.time()
+        conn = self.__conn()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO entries (key, url, body, size, created, expires, accessed, etag, last_modified) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, url, data, len(data), now, now + max(ttl, 0), now, etag, last_modified)
+            )
+        with self.__lock:
+            self.__writes += 1
+            prune = self.__writes % _PRUNE_INTERVAL == 0
+        if prune:
+            self.prune()
+
+    def refresh(self, key, ttl):
+        # The server confirmed the stored body is still current
+        now = time.time()
+        conn = self.__conn()
+        with conn:
+            conn.execute('UPDATE entries SET expires = ?, accessed = ? WHERE key = ?', (now + max(ttl, 0), now, key))
+
+    def delete(self, key):
+        conn = self.__conn()
+        with conn:
+            conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def prune(self, max_size=None):
+        # Drop expired entries, then least recently used ones until the store fits in max_size bytes
+        if max_size is None:
+            max_size = config.get('cache_max_size_mb') * 1024 * 1024
+        conn = self.__conn()
+        with conn:
+            # Expired entries with validators are kept a while longer, they can still be revalidated cheaply
+            now = time.time()
+            removed = conn.execute(
+                'DELETE FROM entries WHERE expires < ? AND ((etag IS NULL AND last_modified IS NULL) OR expires < ?)',
+                (now, now - config.get('cache_revalidate_window'))
+            ).rowcount
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total > max_size:
+                rows = conn.execute('SELECT key, size FROM entries ORDER BY accessed ASC').fetchall()
+                evict = []
+                for key, size in rows:
+                    if total <= max_size:
+                        break
+                    evict.append((key,))
+                    total -= size
+                conn.executemany('DELETE FROM entries WHERE key = ?', evict)
+                removed += len(evict)
+        logger.info(f'Pruned {removed} entries from metadata cache, {total} bytes remaining')
+        return removed
+
+    def clear(self):
+        conn = self.__conn()
+        with conn:
+            conn.execute('DELETE FROM entries')
+        conn.execute('VACUUM')
+
+    def stats(self):
+        conn = self.__conn()
+        count, size, expired = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(expires < ?), 0) FROM entries',
+            (time.time(),)
+        ).fetchone()
+        return {'path': self.path, 'entries': count, 'size': size, 'expired': expired}
+
+
+class MemoryCache:
+    # Size bounded LRU of parsed api objects, concurrent loads of the same key share a single request
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self.__items = OrderedDict()
+        self.__pending = {}
+        self.__lock = threading.Lock()
+
+    def __contains__(self, key):
+        # Membership only, neither counted in the stats nor refreshing the entry
+        with self.__lock:
+            return key in self.__items
+
+    def get(self, key):
+        with self.__lock:
+            if key in self.__items:
+                self.__items.move_to_end(key)
+                self.hits += 1
+                return self.__items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__items[key] = value
+            self.__items.move_to_end(key)
+            while len(self.__items) > self.max_items:
+                self.__items.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        with self.__lock:
+            if key in self.__items:
+                self.__items.move_to_end(key)
+                self.hits += 1
+                return self.__items[key]
+            event = self.__pending.get(key)
+            owner = event is None
+            if owner:
+                event = self.__pending[key] = threading.Event()
+                self.misses += 1
+        if not owner:
+            event.wait()
+            value = self.get(key)
+            # The request we waited on failed, try it ourselves
+            return value if value is not None else loader()
+        try:
+            value = loader()
+            if value is not None:
+                self.put(key, value)
+            return value
+        finally:
+            with self.__lock:
+                self.__pending.pop(key, None)
+            event.set()
+
+    def stats(self):
+        with self.__lock:
+            return {'items': len(self.__items), 'hits': self.hits, 'misses': self.misses}
+
+
+cache = CacheStore()
+album_cache = MemoryCache(config.get('metadata_memory_cache_size'))
+artist_cache = MemoryCache(config.get('metadata_memory_cache_size'))
+episode_cache = MemoryCache(config.get('episode_store_size'))
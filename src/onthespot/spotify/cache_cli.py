@@ -0,0 +1,47 @@
+import argparse
+import os
+import sys
+from ..otsconfig import config
+from .cache import cache
+
+# Kept apart from cache.py, running that module directly would create a second CacheStore next to the imported one
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m onthespot.spotify.cache_cli',
+                                     description='Inspect and maintain the OnTheSpot metadata cache.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('stats', help='Show entry count and size')
+    prune_cmd = commands.add_parser('prune', help='Drop expired and least recently used entries')
+    prune_cmd.add_argument('--max-size-mb', type=int, default=None)
+    commands.add_parser('clear', help='Drop every entry')
+    warm_cmd = commands.add_parser('warm', help='Fetch and cache every api url listed in a file')
+    warm_cmd.add_argument('file')
+    args = parser.parse_args(argv)
+
+    if args.command == 'stats':
+        for key, value in cache.stats().items():
+            print(f'{key}: {value}')
+    elif args.command == 'prune':
+        max_size = args.max_size_mb * 1024 * 1024 if args.max_size_mb is not None else None
+        print(f'Removed {cache.prune(max_size)} entries')
+    elif args.command == 'clear':
+        cache.clear()
+        print('Cache cleared')
+    elif args.command == 'warm':
+        from ..utils.utils import login_user
+        from ..otsconfig import config_dir
+        from .api import warm_cache
+        with open(args.file, 'r', encoding='utf-8') as f:
+            urls = [line.strip() for line in f if line.strip()]
+        account = config.get('accounts')[config.get('parsing_acc_sn') - 1]
+        login = login_user(account[0], "", os.path.join(config_dir(), 'onthespot', 'sessions'), account[3])
+        if login is None or not login[0]:
+            print('Could not log in with the parsing account')
+            return 1
+        print(f'Cached {warm_cache(login[1], urls)} of {len(urls)} urls')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit, parse_qsl, urlencode
+import requests
+from requests.structures import CaseInsensitiveDict
+from ..otsconfig import config
+from ..runtimedata import get_logger
+
+logger = get_logger("spotify.cassette")
+
+# Response headers worth replaying, everything else differs between runs
+RECORDED_HEADERS = ['Content-Type', 'ETag', 'Last-Modified', 'Retry-After']
+CONDITIONAL_HEADERS = ['If-None-Match', 'If-Modified-Since']
+
+
+def normalize_request(method, url, params=None):
+    # Query parameters are sorted so the same call made with a dict, a string or a 'next' url gets one entry,
+    # headers are left out since the access token changes between runs
+    prepared = requests.Request(method, url, params=params).prepare()
+    parts = urlsplit(prepared.url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return f'{method.upper()} {parts.netloc}{parts.path}' + (f'?{query}' if query else '')
+
+
+class Cassette:
+    # Stores every request/response pair as a json file named after the normalized request, so recordings
+    # replay the same way on any machine
+    def __init__(self, mode, path, latency=0):
+        self.mode = mode
+        self.path = path
+        self.latency = latency
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        logger.info(f'Http cassette in {mode} mode at "{path}"')
+
+    def __file(self, request):
+        return os.path.join(self.path, hashlib.sha1(request.encode()).hexdigest() + '.json')
+
+    def strip_conditional(self, headers):
+        # A recorded 304 has no body to give back when it is replayed against an empty cache
+        if not headers:
+            return headers
+        return {key: value for key, value in headers.items() if key not in CONDITIONAL_HEADERS}
+
+    def record(self, method, url, params, response):
+        request = normalize_request(method, url, params)
+        entry = {
+            'request': request,
+            'status': response.status_code,
+            'headers': {key: response.headers[key] for key in RECORDED_HEADERS if key in response.headers},
+        }
+        try:
+            entry['body'] = response.content.decode('utf-8')
+        except UnicodeDecodeError:
+            entry['body_b64'] = base64.b64encode(response.content).decode('ascii')
+        with self.__lock:
+            with open(self.__file(request), 'w', encoding='utf-8') as f:
+                json.dump(entry, f, indent=1)
+        return response
+
+    def replay(self, method, url, params):
+        request = normalize_request(method, url, params)
+        if self.latency:
+            time.sleep(self.latency)
+        response = requests.Response()
+        response.url = url
+        response.encoding = 'utf-8'
+        try:
+            with open(self.__file(request), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            logger.warning(f'No recording for "{request}", replaying 404')
+            with self.__lock:
+                self.misses += 1
+            response.status_code = 404
+            response._content = b''
+            return response
+        with self.__lock:
+            self.hits += 1
+        response.status_code = entry['status']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        if 'body_b64' in entry:
+            response._content = base64.b64decode(entry['body_b64'])
+        else:
+            response._content = entry['body'].encode('utf-8')
+        return response
+
+    def stats(self):
+        with self.__lock:
+            return {'mode': self.mode, 'path': self.path, 'hits': self.hits, 'misses': self.misses}
+
+
+def load_cassette():
+    # The environment wins over the config so a benchmark run never has to touch the user's settings
+    mode = os.environ.get('HTTP_CASSETTE_MODE', config.get('http_cassette_mode'))
+    if mode not in ['record', 'replay']:
+        return None
+    path = os.environ.get('HTTP_CASSETTE_DIR', config.get('http_cassette_dir')) or \
+        os.path.join(config.get('_cache_dir'), 'cassettes')
+    latency = float(os.environ.get('HTTP_CASSETTE_LATENCY', config.get('http_cassette_latency')))
+    return Cassette(mode, os.path.abspath(path), latency)
+
+
+def recording():
+    return cassette is not None and cassette.mode == 'record'
+
+
+cassette = load_cassette()
@@ -0,0 +1,184 @@
+import io
+import queue
+import threading
+import time
+from ..otsconfig import config
+from ..runtimedata import get_logger
+
+logger = get_logger("spotify.chunkreader")
+
+# One buffer is filled from the stream while the other is written out
+BUFFERS = 2
+# Adaptive sizes are rounded to this, and never change by more than SIZE_STEP times per read
+SIZE_ALIGN = 4096
+SIZE_STEP = 2
+
+
+def supports_readinto(stream):
+    # librespot's AbsChunkedInputStream subclasses BytesIO without overriding readinto, the inherited one would
+    # read BytesIO's own empty buffer instead of the audio. Only trust readinto when it is defined above BytesIO,
+    # so real downloads always take the read() path and only streams like the benchmarks' fake one read in place.
+    for cls in type(stream).__mro__:
+        if cls is io.BytesIO:
+            return False
+        if 'readinto' in cls.__dict__:
+            return True
+    return False
+
+
+class ChunkStats:
+    # Read sizes picked across all downloads, bucketed by power of two
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__reads = 0
+        self.__bytes = 0
+        self.__read_time = 0
+        self.__sizes = {}
+
+    def record(self, size, read, elapsed):
+        bucket = 1 << max(size - 1, 0).bit_length()
+        with self.__lock:
+            self.__reads += 1
+            self.__bytes += read
+            self.__read_time += elapsed
+            self.__sizes[bucket] = self.__sizes.get(bucket, 0) + 1
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'reads': self.__reads,
+                'bytes': self.__bytes,
+                'mean_chunk': round(self.__bytes / self.__reads) if self.__reads else 0,
+                'read_time': round(self.__read_time, 3),
+                'sizes': dict(sorted(self.__sizes.items())),
+            }
+
+
+class ChunkSizer:
+    # Picks the next read size so a read takes about chunk_target_latency at the measured throughput. Fast links
+    # get large reads with little per chunk overhead, slow ones small reads that keep cancelling and progress
+    # responsive. With adaptive_chunk_size off this is the fixed chunk_size, shortened to what is left.
+    def __init__(self):
+        self.adaptive = config.get('adaptive_chunk_size')
+        self.__minimum = config.get('chunk_size_min')
+        self.__maximum = max(config.get('chunk_size_max'), self.__minimum)
+        self.__target = config.get('chunk_target_latency')
+        self.__rate = None
+        self.__reads = 0
+        self.__bytes = 0
+        self.__read_time = 0
+        self.__smallest = None
+        self.__largest = 0
+        self.size = config.get('chunk_size')
+        if self.adaptive:
+            self.size = self.__clamp(self.size)
+
+    def __clamp(self, size):
+        return min(max(int(size) // SIZE_ALIGN * SIZE_ALIGN, self.__minimum), self.__maximum)
+
+    def next(self, remaining):
+        # The tail of the stream is read with exactly what is left, the end of stream checks rely on it
+        return min(self.size, remaining)
+
+    def update(self, size, read, elapsed):
+        chunk_stats.record(size, read, elapsed)
+        self.__reads += 1
+        self.__bytes += read
+        self.__read_time += elapsed
+        self.__smallest = size if self.__smallest is None else min(self.__smallest, size)
+        self.__largest = max(self.__largest, size)
+        if not self.adaptive or read == 0 or read < size:
+            # Short reads happen at the end of the stream and say nothing about the link
+            return
+        rate = read / max(elapsed, 0.000001)
+        self.__rate = rate if self.__rate is None else self.__rate * 0.7 + rate * 0.3
+        target = self.__rate * self.__target
+        self.size = self.__clamp(min(max(target, self.size / SIZE_STEP), self.size * SIZE_STEP))
+
+    def summary(self):
+        # One line about the reads of a single download, for the debug log
+        mode = 'adaptive' if self.adaptive else 'fixed'
+        if not self.__reads:
+            return f'{mode} chunks, nothing read'
+        throughput = self.__bytes / max(self.__read_time, 0.000001) / 1024
+        return (f'{mode} chunks, {self.__reads} reads of {self.__smallest}-{self.__largest} bytes, '
+                f'mean {self.__bytes // self.__reads}, last {self.size}, {throughput:.0f} KiB/s while reading')
+
+
+chunk_stats = ChunkStats()
+
+
+class ChunkReader:
+    # Hands chunks to a writer thread, so the next chunk is decrypted while the previous one is still being written
+    # to disk or piped into ffmpeg. Streams with a usable readinto fill two preallocated buffers in turn, the bytes
+    # returned by read() are passed on as they are. Either way at most BUFFERS chunks are in flight.
+    def __init__(self, stream, file, sizer):
+        self.__stream = stream
+        self.__file = file
+        self.__sizer = sizer
+        self.__readinto = supports_readinto(stream)
+        self.__free = queue.Queue()
+        self.__filled = queue.Queue()
+        self.__error = None
+        self.__aborted = False
+        self.__closed = False
+        for _ in range(BUFFERS):
+            self.__free.put(bytearray(sizer.size) if self.__readinto else None)
+        self.__writer = threading.Thread(target=self.__write, name='chunk-writer', daemon=True)
+        self.__writer.start()
+
+    def read(self, size):
+        # Returns the number of bytes read and queued for writing, write errors surface on the next read
+        if self.__error is not None:
+            raise self.__error
+        buffer = self.__free.get()
+        start = time.perf_counter()
+        if self.__readinto:
+            if len(buffer) < size:
+                buffer = bytearray(size)
+            with memoryview(buffer) as view:
+                read = self.__stream.readinto(view[:size]) or 0
+        else:
+            buffer = self.__stream.read(size)
+            read = len(buffer)
+        self.__sizer.update(size, read, time.perf_counter() - start)
+        if read:
+            self.__filled.put((buffer, read))
+        else:
+            self.__free.put(buffer if self.__readinto else None)
+        return read
+
+    def __write(self):
+        while True:
+            item = self.__filled.get()
+            if item is None:
+                return
+            buffer, size = item
+            if self.__error is None and not self.__aborted:
+                try:
+                    with memoryview(buffer) as view:
+                        written = 0
+                        # Raw pipes may accept less than asked for
+                        while written < size:
+                            written += self.__file.write(view[written:size]) or 0
+                except Exception as exc:
+                    logger.error(f'Writing chunk failed: {exc}')
+                    self.__error = exc
+            self.__free.put(buffer if self.__readinto else None)
+
+    def close(self):
+        # Waits until every queued chunk is written
+        if not self.__closed:
+            self.__closed = True
+            self.__filled.put(None)
+            self.__writer.join()
+        if self.__error is not None:
+            raise self.__error
+
+    def abort(self):
+        # Drops chunks that were not written yet, used before the output is discarded
+        self.__aborted = True
+        if not self.__closed:
+            self.__closed = True
+            self.__filled.put(None)
+            self.__writer.join()
@@ -0,0 +1,122 @@
+import base64
+import os
+import threading
+from io import BytesIO
+from PIL import Image
+from mutagen.flac import Picture
+from mutagen.id3 import APIC
+from mutagen.mp4 import MP4Cover
+from ..otsconfig import config
+from ..runtimedata import get_logger
+from .http_client import client
+from .cache import MemoryCache
+
+logger = get_logger("spotify.covers")
+
+# Formats PIL names differently from the extension users put in album_cover_format
+_FORMAT_ALIASES = {'jpg': 'jpeg', 'tif': 'tiff'}
+
+
+def normalize_format(fmt):
+    fmt = fmt.lower().lstrip('.')
+    return _FORMAT_ALIASES.get(fmt, fmt)
+
+
+class Cover:
+    # Raw bytes of one cover plus everything derived from them, built at most once per format
+    def __init__(self, url, raw):
+        self.url = url
+        self.raw = raw
+        # Payloads are built from the encoded bytes, which take the same lock
+        self.__lock = threading.RLock()
+        self.__derived = {}
+        with Image.open(BytesIO(raw)) as img:
+            # Only reads the header, the pixels are decoded when a conversion is needed
+            self.raw_format = (img.format or '').lower()
+            self.raw_mode = img.mode
+
+    def __get(self, key, build):
+        with self.__lock:
+            if key not in self.__derived:
+                self.__derived[key] = build()
+            return self.__derived[key]
+
+    def mime(self, fmt):
+        return f'image/{normalize_format(fmt)}'
+
+    def encoded(self, fmt):
+        fmt = normalize_format(fmt)
+        if fmt == self.raw_format and self.raw_mode == 'RGB':
+            return self.raw
+        return self.__get(('encoded', fmt), lambda: self.__encode(fmt))
+
+    def __encode(self, fmt):
+        logger.debug(f'Re-encoding cover "{self.url}" from {self.raw_format} to {fmt}')
+        img = Image.open(BytesIO(self.raw))
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        buf = BytesIO()
+        img.save(buf, format=fmt)
+        return buf.getvalue()
+
+    def apic(self, fmt):
+        return self.__get(('apic', normalize_format(fmt)), lambda: APIC(
+            encoding=3,
+            mime=self.mime(fmt),
+            type=3, desc=u'Cover',
+            data=self.encoded(fmt)
+        ))
+
+    def vorbis_picture(self, fmt):
+        # Base64 METADATA_BLOCK_PICTURE shared by flac and ogg vorbis comments
+        def build():
+            picture = Picture()
+            picture.data = self.encoded(fmt)
+            picture.type = 3
+            picture.desc = "Cover"
+            picture.mime = self.mime(fmt)
+            return base64.b64encode(picture.write()).decode("ascii")
+        return self.__get(('vorbis', normalize_format(fmt)), build)
+
+    def mp4_cover(self, fmt):
+        image_format = MP4Cover.FORMAT_PNG if normalize_format(fmt) == 'png' else MP4Cover.FORMAT_JPEG
+        return self.__get(('mp4', normalize_format(fmt)),
+                          lambda: MP4Cover(data=self.encoded(fmt), imageformat=image_format))
+
+
+class CoverCache:
+    # Covers keyed by image url, every track of an album downloads and converts its cover only once
+    def __init__(self, max_items):
+        self.__covers = MemoryCache(max_items)
+
+    def get(self, image_url):
+        return self.__covers.get_or_load(image_url, lambda: self.__fetch(image_url))
+
+    def __fetch(self, image_url):
+        logger.info(f'Fetching cover "{image_url}"')
+        response = client.get(image_url)
+        response.raise_for_status()
+        return Cover(image_url, response.content)
+
+    def save(self, cover, directory, fmt):
+        # Written by whichever track of the album gets here first, the exclusive open lets the others skip it
+        cover_path = os.path.join(directory, 'cover' + "." + fmt)
+        if os.path.exists(cover_path):
+            return
+        try:
+            f = open(cover_path, 'xb')
+        except FileExistsError:
+            return
+        try:
+            with f:
+                f.write(cover.encoded(fmt))
+        except Exception:
+            # Leave no partial cover behind, the next track of the album tries again
+            os.remove(cover_path)
+            raise
+
+    def stats(self):
+        return self.__covers.stats()
+
+
+cover_cache = CoverCache(config.get('cover_cache_size'))
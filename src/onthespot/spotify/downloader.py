@@ -5,20 +5,28 @@ import subprocess
 import time
 import traceback
 
-import requests
 from PyQt6.QtCore import QObject, pyqtSignal
 from librespot.audio.decoders import AudioQuality, VorbisOnlyAudioQuality
 from librespot.metadata import TrackId, EpisodeId
 from urllib3.exceptions import MaxRetryError, NewConnectionError
 
 from ..otsconfig import config
-from ..runtimedata import get_logger, cancel_list, failed_downloads, unavailable, session_pool
+from ..runtimedata import get_logger, cancel_list, failed_downloads, unavailable, session_pool, song_info_store
 from ..utils.utils import sanitize_data
-from .api import check_premium, get_song_info, convert_audio_format, set_music_thumbnail, set_audio_tags, \
-    get_episode_info, get_track_lyrics
+from .api import check_premium, get_song_info, get_episode_info, get_episodes_data, open_audio_encoder, log_network_stats
+from .lyrics import lyrics_service
+from .postprocess import post_processor, staging_path
+from .chunkreader import ChunkReader, ChunkSizer
+from .progress import progress_aggregator
+from .http_client import client
+from .cache import episode_cache
 from ..utils.utils import re_init_session, fetch_account_uuid
 
 
+def stream_conversion():
+    return config.get('stream_conversion') and not config.get('force_raw')
+
+
 class DownloadWorker(QObject):
     finished = pyqtSignal()
     progress = pyqtSignal(list)
@@ -27,10 +35,40 @@ class DownloadWorker(QObject):
     logger = None
     __session_uuid = None
     __queue = None
+    __item = None
     __stop = False
     __last_cancelled = False
     __stopped = False
 
+    def open_output(self, path, quality):
+        # With stream conversion ffmpeg encodes chunks as they arrive, otherwise the raw ogg is staged
+        if stream_conversion():
+            encoder = open_audio_encoder(path, quality)
+            return encoder, encoder.stdin
+        return None, open(path, 'wb')
+
+    def discard_output(self, file, encoder, path, reader):
+        # ffmpeg goes first, a writer blocked on its full stdin pipe only returns once the process is gone
+        if encoder is not None and encoder.poll() is None:
+            encoder.kill()
+        if reader is not None:
+            reader.abort()
+        if file is not None:
+            file.close()
+        if encoder is not None:
+            encoder.wait()
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+    def queued_episode_ids(self, limit):
+        with self.__queue.mutex:
+            items = list(self.__queue.queue)
+        return [item['media_id'] for item in items if item.get('media_type') == 'episode'][:limit]
+
+    def finish_output(self, encoder):
+        if encoder is not None and encoder.wait() != 0:
+            raise subprocess.CalledProcessError(encoder.returncode, encoder.args)
+
     def download_track(self, session, track_id_str, extra_paths="", extra_path_as_root=False,
                        playlist_name='', playlist_owner='', playlist_desc=''):
         trk_track_id_str = track_id_str
@@ -45,17 +83,18 @@ class DownloadWorker(QObject):
             self.__last_cancelled = True
             return False
         skip_existing_file = True
-        chunk_size = config.get("chunk_size")
         quality = AudioQuality.HIGH
         if check_premium(session) or config.get('force_premium'):
             quality = AudioQuality.VERY_HIGH
 
         try:
-            song_info = get_song_info(session, track_id_str)
+            song_info = song_info_store.pop(track_id_str, None)
+            if song_info is None:
+                song_info = get_song_info(session, track_id_str)
 
             if config.get("translate_file_path"):
                 def translate(string):
-                    return requests.get(f"https://translate.googleapis.com/translate_a/single?dj=1&dt=t&dt=sp&dt=ld&dt=bd&client=dict-chrome-ex&sl=auto&tl={config.get('language')}&q={string}").json()["sentences"][0]["trans"]
+                    return client.get(f"https://translate.googleapis.com/translate_a/single?dj=1&dt=t&dt=sp&dt=ld&dt=bd&client=dict-chrome-ex&sl=auto&tl={config.get('language')}&q={string}").json()["sentences"][0]["trans"]
                 _name = translate(song_info['name'])
                 _album = translate(song_info['album_name'])
             else:
@@ -95,6 +134,7 @@ class DownloadWorker(QObject):
             # If extra path as root is enabled, extra path is already set as DL root, unset it
             extra_paths = '' if extra_path_as_root else extra_paths.strip()
             filepath = os.path.join(dl_root, extra_paths, song_path)
+            staged = encoder = file = reader = None
         except Exception:
             self.logger.error(
                 f"Metadata fetching failed for track by id '{trk_track_id_str}', {traceback.format_exc()}")
@@ -128,105 +168,92 @@ class DownloadWorker(QObject):
                     if track_id_str != song_info['scraped_song_id']:
                         track_id_str = song_info['scraped_song_id']
 
+                    if config.get('inp_enable_lyrics'):
+                        lyrics_service.prefetch(session, trk_track_id_str, "track")
                     track_id = TrackId.from_base62(track_id_str)
                     stream = session.content_feeder().load(track_id, VorbisOnlyAudioQuality(quality), False, None)
-                    os.makedirs(os.path.dirname(filepath), exist_ok=True)
                     total_size = stream.input_stream.size
                     downloaded = 0
-                    _CHUNK_SIZE = chunk_size
+                    sizer = ChunkSizer()
+                    _CHUNK_SIZE = sizer.next(total_size)
                     fail = 0
-                    with open(filepath, 'wb') as file:
+                    staged = staging_path(filepath)
+                    encoder, file = self.open_output(staged, quality)
+                    reader = ChunkReader(stream.input_stream.stream(), file, sizer)
+                    with file:
                         while downloaded < total_size:
                             if trk_track_id_str in cancel_list:
                                 self.progress.emit([trk_track_id_str, self.tr("Cancelled"), [0, 100]])
                                 cancel_list.pop(trk_track_id_str)
                                 self.__last_cancelled = True
-                                if os.path.exists(filepath):
-                                    file.close()
-                                    os.remove(filepath)
+                                self.discard_output(file, encoder, staged, reader)
                                 return False
                             self.logger.debug(
                                 f"Reading chunk of {_CHUNK_SIZE} bytes from stream  track by id '{trk_track_id_str}'")
-                            data = stream.input_stream.stream().read(_CHUNK_SIZE)
+                            read = reader.read(_CHUNK_SIZE)
                             self.logger.debug(
-                                f"Got {len(data)} bytes of data for track by id '{trk_track_id_str}'")
-                            downloaded += len(data)
-                            if len(data) != 0:
-                                file.write(data)
-                                self.progress.emit([trk_track_id_str, None, [downloaded, total_size]])
-                            if len(data) == 0 and _CHUNK_SIZE > config.get("dl_end_padding_bytes"):
+                                f"Got {read} bytes of data for track by id '{trk_track_id_str}'")
+                            downloaded += read
+                            if read != 0:
+                                progress_aggregator.update(trk_track_id_str, downloaded, total_size)
+                            if read == 0 and _CHUNK_SIZE > config.get("dl_end_padding_bytes"):
                                 self.logger.error(
                                     f"PD Error for track by id '{trk_track_id_str}', "
                                     f"while reading chunk size: {_CHUNK_SIZE}"
                                 )
                                 fail += 1
-                            elif len(data) == 0 and _CHUNK_SIZE <= config.get("dl_end_padding_bytes"):
+                            elif read == 0 and _CHUNK_SIZE <= config.get("dl_end_padding_bytes"):
                                 break
-                            if (total_size - downloaded) < _CHUNK_SIZE:
-                                _CHUNK_SIZE = total_size - downloaded
+                            _CHUNK_SIZE = sizer.next(total_size - downloaded)
                             if fail > config.get("max_retries"):
                                 self.progress.emit([trk_track_id_str, self.tr("RETRY ") + str(fail + 1), None])
                                 self.logger.error(f"Max retries exceed for track by id '{trk_track_id_str}'")
                                 self.progress.emit([trk_track_id_str, self.tr("PD error. Will retry"), None])
-                                if os.path.exists(filepath):
-                                    os.remove(filepath)
+                                self.discard_output(file, encoder, staged, reader)
                                 return None
-                            self.progress.emit([trk_track_id_str, None, [downloaded, total_size]])
-                    if not config.get("force_raw"):
-                        self.progress.emit([trk_track_id_str, self.tr("Converting"), None])
-                        convert_audio_format(filepath, quality)
-                        self.progress.emit([trk_track_id_str, self.tr("Writing metadata"), None])
-                        set_audio_tags(filepath, song_info, trk_track_id_str)
-                        self.progress.emit([trk_track_id_str, self.tr("Setting thumbnail"), None])
-                        set_music_thumbnail(filepath, song_info['image_url'])
-                    else:
+                        reader.close()
+                    self.finish_output(encoder)
+                    if config.get("force_raw"):
                         self.logger.warning(
                             f"Force raw is disabled for track by id '{trk_track_id_str}', "
                             f"media converting and tagging will be done !"
                         )
-                    self.logger.info(f"Downloaded track by id '{trk_track_id_str}'")
-                    if config.get('inp_enable_lyrics'):
-                        self.progress.emit([trk_track_id_str, self.tr("Getting Lyrics"), None])
-                        self.logger.info(f'Fetching lyrics for track id: {trk_track_id_str}, '
-                                         f'{config.get("only_synced_lyrics")}')
-                        try:
-                            lyrics = get_track_lyrics(session, trk_track_id_str, "track", song_info, config.get('only_synced_lyrics'))
-                            if lyrics:
-                                self.logger.info(f'Found lyrics for: {trk_track_id_str}, writing...')
-                                if config.get('use_lrc_file'):
-                                    with open(filepath[0:-len(config.get('media_format'))] + 'lrc', 'w',
-                                              encoding='utf-8') as f:
-                                        f.write(lyrics["lyrics"])
-                                if config.get('embed_lyrics'):
-                                    set_audio_tags(filepath, {"lyrics": lyrics["lyrics"], "language": lyrics["language"]}, trk_track_id_str)
-                                self.logger.info(f'lyrics saved for: {trk_track_id_str}')
-                        except Exception:
-                            self.logger.error(f'Could not get lyrics for {trk_track_id_str}, '
-                                              f'unexpected error: {traceback.format_exc()}')
-                    self.progress.emit([trk_track_id_str, self.tr("Downloaded"), [100, 100],
-                                        filepath,
-                                        f'{song_info["name"]} [{_artist} - {song_info["album_name"]}:{song_info["release_year"]}].f{config.get("media_format")}'])
+                    self.logger.info(f"Streamed track by id '{trk_track_id_str}', handing over to post processing")
+                    self.logger.debug(f"Track by id '{trk_track_id_str}': {sizer.summary()}")
+                    self.progress.emit([trk_track_id_str, self.tr("Waiting to convert"), None])
+                    post_processor.submit({
+                        'media_id': trk_track_id_str,
+                        'item_type': 'track',
+                        'worker': self,
+                        'session': session,
+                        'retry_item': self.__item,
+                        'staging_path': staged,
+                        'filepath': filepath,
+                        'display_name': f'{song_info["name"]} [{_artist} - {song_info["album_name"]}:{song_info["release_year"]}].f{config.get("media_format")}',
+                        'quality': quality,
+                        'convert': not config.get("force_raw") and encoder is None,
+                        'tags': None if config.get("force_raw") else song_info,
+                        'image_url': song_info['image_url'],
+                        'lyrics_metadata': song_info,
+                    })
                     return True
         except queue.Empty:
-            if os.path.exists(filepath):
-                os.remove(filepath)
+            self.discard_output(file, encoder, staged, reader)
             self.logger.error(
                 f"Network timeout from spotify for track by id '{trk_track_id_str}', download will be retried !")
             self.progress.emit([trk_track_id_str, self.tr("Timeout. Will retry"), None])
             return None
-        except subprocess.CalledProcessError as exc:
-            if os.path.exists(filepath):
-                os.remove(filepath)
+        except (subprocess.CalledProcessError, BrokenPipeError) as exc:
+            # ffmpeg exited early while the stream was being piped into it
+            self.discard_output(file, encoder, staged, reader)
             self.logger.error(
                 f"Decoding error for track by id '{trk_track_id_str}', "
-                f"possibly due to use of rate limited spotify account ! {exc.returncode} | {exc.output}"
+                f"possibly due to use of rate limited spotify account ! {exc}"
             )
             self.progress.emit([trk_track_id_str, self.tr("Decode error. Will retry"), None])
-            traceback.print_exc()
             return None
         except Exception:
-            if os.path.exists(filepath):
-                os.remove(filepath)
+            self.discard_output(file, encoder, staged, reader)
             self.progress.emit([trk_track_id_str, self.tr("Failed"), [0, 100]])
             self.logger.error(
                 f"Download failed for track by id '{trk_track_id_str}', Unexpected error: {traceback.format_exc()} !")
@@ -235,22 +262,29 @@ class DownloadWorker(QObject):
     def download_episode(self, session, episode_id_str, extra_paths="", extra_path_as_root=False):
         self.logger.info(f"Downloading episode by id '{episode_id_str}'")
         quality = AudioQuality.HIGH
+        if episode_id_str not in episode_cache:
+            # Resolve the queued episodes the store lost along with this one
+            get_episodes_data(session, [episode_id_str] + self.queued_episode_ids(49))
         podcast_name, episode_name, thumbnail, release_date, total_episodes, artist, language, description, copyright, length = get_episode_info(session, episode_id_str)
         skip_existing_file = True
-        if extra_paths == "":
-            extra_paths = os.path.join(extra_paths, podcast_name)
         if podcast_name is None:
             self.progress.emit([episode_id_str, self.tr("Not Found"), [0, 100]])
             self.logger.error(f"Download failed for episode by id '{episode_id_str}', Not found")
             return False
         else:
+            if extra_paths == "":
+                extra_paths = os.path.join(extra_paths, podcast_name)
+            staged = encoder = file = reader = None
             try:
                 filename = podcast_name + " - " + episode_name
+                if config.get('inp_enable_lyrics'):
+                    lyrics_service.prefetch(session, episode_id_str, "episode")
                 episode_id = EpisodeId.from_base62(episode_id_str)
                 stream = session.content_feeder().load(episode_id, VorbisOnlyAudioQuality(quality), False, None)
                 total_size = stream.input_stream.size
                 downloaded = 0
-                _CHUNK_SIZE = config.get("chunk_size")
+                sizer = ChunkSizer()
+                _CHUNK_SIZE = sizer.next(total_size)
                 fail = 0
 
                 audio_name = config.get("podcast_path_formatter").format(
@@ -276,33 +310,30 @@ class DownloadWorker(QObject):
                     self.logger.info(f"Episode by id '{episode_id_str}', already exists.. Skipping ")
                     self.progress.emit([episode_id_str, self.tr("Downloaded"), [100, 100], file_path, filename])
                     return True
-                with open(file_path, 'wb') as file:
+                staged = staging_path(file_path)
+                encoder, file = self.open_output(staged, quality)
+                reader = ChunkReader(stream.input_stream.stream(), file, sizer)
+                with file:
                     while downloaded <= total_size:
                         if episode_id_str in cancel_list:
                             self.progress.emit([episode_id_str, self.tr("Cancelled"), [0, 100]])
                             cancel_list.pop(episode_id_str)
                             self.__last_cancelled = True
-                            if os.path.exists(file_path):
-                                file.close()
-                                os.remove(file_path)
+                            self.discard_output(file, encoder, staged, reader)
                             return False
-                        data = stream.input_stream.stream().read(_CHUNK_SIZE)
-                        downloaded += len(data)
-                        file.write(data)
-                        self.progress.emit([episode_id_str, None, [downloaded, total_size], file_path, filename])
-                        if (total_size - downloaded) < _CHUNK_SIZE:
-                            _CHUNK_SIZE = total_size - downloaded
-                        if len(data) == 0:
+                        read = reader.read(_CHUNK_SIZE)
+                        downloaded += read
+                        progress_aggregator.update(episode_id_str, downloaded, total_size)
+                        _CHUNK_SIZE = sizer.next(total_size - downloaded)
+                        if read == 0:
                             fail += 1
                         if fail > config.get("max_retries"):
                             self.progress.emit([episode_id_str, self.tr("RETRY ") + str(fail + 1), None])
                             break
+                    reader.close()
+                self.finish_output(encoder)
                 self.logger.info(f"Episode by id '{episode_id_str}', downloaded")
-                if not config.get("force_raw"):
-                    self.progress.emit([episode_id_str, self.tr("Converting"), None, file_path, filename])
-                    convert_audio_format(file_path, quality)
-                self.logger.info(f'Writing metadata for episode "{episode_id_str}" ')
-                self.progress.emit([episode_id_str, self.tr("Writing metadata"), None, file_path, filename])
+                self.logger.debug(f"Episode by id '{episode_id_str}': {sizer.summary()}")
 
                 episode_info = {}
                 episode_info['name'] = episode_name
@@ -315,44 +346,34 @@ class DownloadWorker(QObject):
                 episode_info['description'] = description
                 episode_info['copyright'] = copyright
                 episode_info['length'] = length
-                set_audio_tags(file_path, episode_info, episode_id_str)
-
-                self.progress.emit([episode_id_str, self.tr("Setting thumbnail"), None, file_path, filename])
-                self.logger.info(f'Setting thumbnail for episode "{episode_id_str}" ')
-                set_music_thumbnail(file_path, thumbnail)
-
-                if config.get('inp_enable_lyrics'):
-                    self.progress.emit([episode_id_str, self.tr("Getting Lyrics"), None])
-                    self.logger.info(f'Fetching lyrics for track id: {episode_id_str}, '
-                                     f'{config.get("only_synced_lyrics")}')
-                    try:
-                        lyrics = get_track_lyrics(session, episode_id_str, "episode", episode_info, config.get('only_synced_lyrics'))
-                        if lyrics:
-                            self.logger.info(f'Found lyrics for: {episode_id_str}, writing...')
-                            if config.get('use_lrc_file'):
-                                with open(file_path[0:-len(config.get('media_format'))] + 'lrc', 'w',
-                                          encoding='utf-8') as f:
-                                    f.write(lyrics["lyrics"])
-                            if config.get('embed_lyrics'):
-                                set_audio_tags(file_path, {"lyrics": lyrics["lyrics"]}, episode_id_str)
-                            self.logger.info(f'lyrics saved for: {episode_id_str}')
-                    except Exception:
-                        self.logger.error(f'Could not get lyrics for {episode_id_str}, '
-                                          f'unexpected error: {traceback.format_exc()}')
 
-                self.progress.emit([episode_id_str, self.tr("Downloaded"), [100, 100], file_path, filename])
+                self.progress.emit([episode_id_str, self.tr("Waiting to convert"), None, file_path, filename])
+                post_processor.submit({
+                    'media_id': episode_id_str,
+                    'item_type': 'episode',
+                    'worker': self,
+                    'session': session,
+                    'retry_item': self.__item,
+                    'staging_path': staged,
+                    'filepath': file_path,
+                    'display_name': filename,
+                    'quality': quality,
+                    'convert': not config.get("force_raw") and encoder is None,
+                    'tags': episode_info,
+                    'image_url': thumbnail,
+                    'lyrics_metadata': episode_info,
+                })
                 return True
-            except subprocess.CalledProcessError as exc:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
+            except (subprocess.CalledProcessError, BrokenPipeError) as exc:
+                self.discard_output(file, encoder, staged, reader)
                 self.logger.error(
-                    f"Decoding error for track by id '{episode_id_str}', "
-                    f"possibly due to use of rate limited spotify account ! {exc.returncode} | {exc.output}"
+                    f"Decoding error for episode by id '{episode_id_str}', "
+                    f"possibly due to use of rate limited spotify account ! {exc}"
                 )
                 self.progress.emit([episode_id_str, self.tr("Decode error. Will retry"), None])
-                traceback.print_exc()
                 return None
             except Exception:
+                self.discard_output(file, encoder, staged, reader)
                 self.logger.error(
                     f"Downloading failed for episode by id "
                     f"'{episode_id_str}', Unexpected Exception: {traceback.format_exc()}"
@@ -373,6 +394,7 @@ class DownloadWorker(QObject):
             if self.__stop:
                 break
             attempt = 0
+            self.__item = item
             self.__last_cancelled = status = False
             while attempt < config.get("max_retries") and status is not True and item is not None:
                 self.logger.info(f"Processing download for track by id '{item['media_id']}', Attempt: {attempt}/{config.get('max_retries')}")
@@ -429,6 +451,8 @@ class DownloadWorker(QObject):
                             failed_downloads[item['media_id']] = item
                         break
                     # Else, It was not cancelled, download just failed ! Retry until we hit max retries
+            if self.__queue.empty():
+                log_network_stats()
             if not self.__last_cancelled:
                 time.sleep(config.get("download_delay"))
         self.__stopped = True
@@ -0,0 +1,107 @@
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from ..otsconfig import config
+from ..runtimedata import get_logger
+from .ratelimit import scheduler, RATE_LIMITED_HOSTS
+from .cassette import cassette
+
+logger = get_logger("spotify.http_client")
+
+# gzip and deflate, plus brotli and zstd when their decoders are installed
+ACCEPT_ENCODING = make_headers(accept_encoding=True)['accept-encoding']
+
+
+class HttpClient:
+    # One keep-alive requests.Session per host, each backed by a bounded urllib3 pool so worker
+    # threads share warm TCP/TLS connections instead of opening a new one for every call.
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__sessions = {}
+        self.__overrides = {}
+
+    def override_host(self, host, base_url):
+        # Sends every request meant for host to base_url instead, for pointing the api layer at a local backend
+        self.__overrides[host] = base_url.rstrip('/')
+
+    def __get_session(self, host):
+        with self.__lock:
+            session = self.__sessions.get(host)
+            if session is None:
+                logger.debug(f'Creating pooled http session for host "{host}"')
+                session = requests.Session()
+                session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=config.get('http_pool_maxsize'),
+                    max_retries=config.get('http_max_retries'),
+                    pool_block=True
+                    )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self.__sessions[host] = session
+            return session
+
+    def request(self, method, url, **kwargs):
+        if cassette is not None and cassette.mode == 'replay':
+            return cassette.replay(method, url, kwargs.get('params'))
+        if cassette is not None:
+            kwargs['headers'] = cassette.strip_conditional(kwargs.get('headers'))
+        kwargs.setdefault('timeout', (config.get('http_connect_timeout'), config.get('http_read_timeout')))
+        parts = urlsplit(url)
+        host = parts.netloc
+        target = url
+        if host in self.__overrides:
+            target = self.__overrides[host] + url[len(f'{parts.scheme}://{host}'):]
+        session = self.__get_session(host)
+        if host in RATE_LIMITED_HOSTS:
+            response = scheduler.request(host, kwargs.get('headers'), lambda: session.request(method, target, **kwargs),
+                                         method)
+        else:
+            response = session.request(method, target, **kwargs)
+        if cassette is not None:
+            cassette.record(method, url, kwargs.get('params'), response)
+        return response
+
+    def get(self, url, params=None, **kwargs):
+        return self.request('GET', url, params=params, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def stats(self):
+        # Returns {host: {'requests': n, 'connections': n, 'reused': n}} read from the urllib3 pools
+        stats = {}
+        with self.__lock:
+            sessions = dict(self.__sessions)
+        for host, session in sessions.items():
+            host_stats = {'requests': 0, 'connections': 0, 'reused': 0}
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in list(pools.keys()):
+                    try:
+                        pool = pools[key]
+                    except KeyError:
+                        continue
+                    host_stats['requests'] += pool.num_requests
+                    host_stats['connections'] += pool.num_connections
+            host_stats['reused'] = max(host_stats['requests'] - host_stats['connections'], 0)
+            stats[host] = host_stats
+        return stats
+
+    def close(self):
+        with self.__lock:
+            for session in self.__sessions.values():
+                session.close()
+            self.__sessions.clear()
+
+
+client = HttpClient()
@@ -0,0 +1,42 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from ..otsconfig import config
+from ..runtimedata import get_logger
+from .api import get_lyrics_data, format_lyrics
+
+logger = get_logger("spotify.lyrics")
+
+# Prefetches of downloads that failed or were cancelled are forgotten past this many
+_MAX_PENDING = 64
+
+
+class LyricsService:
+    # Fetches lyrics in the background while the audio is still streaming, the download worker only
+    # formats them once the file is ready. Hits and misses are both kept in the metadata cache.
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__pending = OrderedDict()
+        self.__executor = ThreadPoolExecutor(max_workers=config.get('lyrics_workers'), thread_name_prefix='lyrics')
+
+    def prefetch(self, session, item_id, item_type):
+        key = (item_type, item_id)
+        with self.__lock:
+            if key in self.__pending:
+                return
+            logger.debug(f'Prefetching lyrics for {item_type}: {item_id}')
+            self.__pending[key] = self.__executor.submit(get_lyrics_data, session, item_id, item_type)
+            while len(self.__pending) > _MAX_PENDING:
+                self.__pending.popitem(last=False)[1].cancel()
+
+    def get(self, session, item_id, item_type, metadata, forced_synced):
+        with self.__lock:
+            future = self.__pending.pop((item_type, item_id), None)
+        if future is not None and not future.cancelled():
+            resp = future.result()
+        else:
+            resp = get_lyrics_data(session, item_id, item_type)
+        return format_lyrics(resp, item_id, item_type, metadata, forced_synced)
+
+
+lyrics_service = LyricsService()
@@ -0,0 +1,172 @@
+import os
+import queue
+import re
+import shutil
+import subprocess
+import threading
+import time
+import traceback
+import uuid
+from ..otsconfig import config
+from ..runtimedata import get_logger, cancel_list, failed_downloads, download_queue
+from .api import convert_audio_format, set_audio_tags, set_music_thumbnail
+from .lyrics import lyrics_service
+
+logger = get_logger("spotify.postprocess")
+
+# .<name>.<id>.part<ext> from staging_path, and the .~ copy convert_audio_format makes of it
+PART_FILE = re.compile(r'^\.(~\.)?.+\.[0-9a-f]{12}\.part(\.\w+)?$')
+
+
+def staging_path(filepath):
+    # Files are streamed next to their destination under a hidden name and renamed into place once complete, the
+    # rename never crosses filesystems. The random part keeps a track queued twice from sharing one file.
+    directory, name = os.path.split(filepath)
+    os.makedirs(directory, exist_ok=True)
+    stem, ext = os.path.splitext(name)
+    return os.path.join(directory, f'.{stem}.{uuid.uuid4().hex[:12]}.part{ext}')
+
+
+def sweep_staging(root=None):
+    # Removes the partial files a crash or kill left in the library, files touched after the sweep started
+    # belong to downloads of this session and are left alone
+    started = time.time()
+    legacy_dir = os.path.join(config.get('_cache_dir'), 'staging')
+    if os.path.isdir(legacy_dir):
+        shutil.rmtree(legacy_dir, ignore_errors=True)
+    removed = 0
+    for directory, _, files in os.walk(root or config.get('download_root')):
+        for name in files:
+            if not PART_FILE.match(name):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < started:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+    if removed:
+        logger.info(f'Removed {removed} partial files left by an earlier session')
+    return removed
+
+
+class PostProcessor:
+    # Download workers only stream audio into staging files and hand them over here. A transcode pool sized to
+    # the cpu runs ffmpeg while a finalize pool tags, embeds covers, writes lyrics and moves files into place.
+    # Both queues are bounded, a download worker waits in submit() once conversions fall too far behind.
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__transcode_queue = queue.Queue(maxsize=config.get('postprocess_queue_size'))
+        self.__finalize_queue = queue.Queue(maxsize=config.get('postprocess_queue_size'))
+        self.__threads = []
+
+    def __start(self):
+        with self.__lock:
+            if self.__threads:
+                return
+            transcode_workers = config.get('transcode_workers') or os.cpu_count() or 1
+            for i in range(transcode_workers):
+                self.__threads.append(threading.Thread(target=self.__run, args=(self.__transcode_queue, self.transcode),
+                                                       name=f'transcode-{i}', daemon=True))
+            for i in range(config.get('finalize_workers')):
+                self.__threads.append(threading.Thread(target=self.__run, args=(self.__finalize_queue, self.finalize),
+                                                       name=f'finalize-{i}', daemon=True))
+            for thread in self.__threads:
+                thread.start()
+            logger.info(f'Post processing started with {transcode_workers} transcode and '
+                        f'{config.get("finalize_workers")} finalize workers')
+
+    def submit(self, job):
+        # job: media_id, item_type, worker, session, retry_item, staging_path, filepath, display_name, quality,
+        # convert, tags, image_url, lyrics_metadata
+        self.__start()
+        if job['convert']:
+            self.__transcode_queue.put(job)
+        else:
+            self.__finalize_queue.put(job)
+
+    def __run(self, stage_queue, stage):
+        while True:
+            job = stage_queue.get()
+            try:
+                if self.__cancelled(job):
+                    continue
+                stage(job)
+            except subprocess.CalledProcessError as exc:
+                logger.error(
+                    f"Decoding error for {job['item_type']} by id '{job['media_id']}', "
+                    f"possibly due to use of rate limited spotify account ! {exc.returncode} | {exc.output}"
+                )
+                self.__fail(job, job['worker'].tr("Decode error. Will retry"))
+            except Exception:
+                logger.error(f"Post processing failed for {job['item_type']} by id '{job['media_id']}', "
+                             f"Unexpected error: {traceback.format_exc()} !")
+                self.__fail(job, job['worker'].tr("Failed. Will retry"))
+
+    def __cancelled(self, job):
+        if job['media_id'] not in cancel_list:
+            return False
+        cancel_list.pop(job['media_id'])
+        failed_downloads[job['media_id']] = {key: value for key, value in job['retry_item'].items()
+                                             if key != 'postprocess_attempts'}
+        self.__discard(job)
+        job['worker'].progress.emit([job['media_id'], job['worker'].tr("Cancelled"), [0, 100]])
+        return True
+
+    def __fail(self, job, status):
+        # The worker has already moved on, so the item goes back on the download queue while retries remain
+        self.__discard(job)
+        item = dict(job['retry_item'])
+        attempts = item.pop('postprocess_attempts', 0) + 1
+        if attempts < config.get('max_retries'):
+            logger.info(f"Queueing {job['item_type']} by id '{job['media_id']}' again, attempt {attempts + 1}/"
+                        f"{config.get('max_retries')}")
+            job['worker'].progress.emit([job['media_id'], status, [0, 100]])
+            download_queue.put(dict(item, postprocess_attempts=attempts))
+        else:
+            failed_downloads[job['media_id']] = item
+            job['worker'].progress.emit([job['media_id'], job['worker'].tr("Failed"), [0, 100]])
+
+    def __discard(self, job):
+        if os.path.exists(job['staging_path']):
+            os.remove(job['staging_path'])
+
+    def transcode(self, job):
+        job['worker'].progress.emit([job['media_id'], job['worker'].tr("Converting"), None])
+        convert_audio_format(job['staging_path'], job['quality'])
+        self.__finalize_queue.put(job)
+
+    def finalize(self, job):
+        worker = job['worker']
+        media_id = job['media_id']
+        path = job['staging_path']
+        filepath = job['filepath']
+        if job['tags'] is not None:
+            worker.progress.emit([media_id, worker.tr("Writing metadata"), None])
+            set_audio_tags(path, job['tags'], media_id)
+            worker.progress.emit([media_id, worker.tr("Setting thumbnail"), None])
+            set_music_thumbnail(path, job['image_url'], cover_dir=os.path.dirname(filepath))
+        if config.get('inp_enable_lyrics'):
+            worker.progress.emit([media_id, worker.tr("Getting Lyrics"), None])
+            logger.info(f'Fetching lyrics for {job["item_type"]} id: {media_id}, {config.get("only_synced_lyrics")}')
+            try:
+                lyrics = lyrics_service.get(job['session'], media_id, job['item_type'], job['lyrics_metadata'],
+                                            config.get('only_synced_lyrics'))
+                if lyrics:
+                    logger.info(f'Found lyrics for: {media_id}, writing...')
+                    if config.get('use_lrc_file'):
+                        with open(filepath[0:-len(config.get('media_format'))] + 'lrc', 'w', encoding='utf-8') as f:
+                            f.write(lyrics["lyrics"])
+                    if config.get('embed_lyrics'):
+                        set_audio_tags(path, {key: lyrics[key] for key in ['lyrics', 'language'] if key in lyrics},
+                                       media_id)
+                    logger.info(f'lyrics saved for: {media_id}')
+            except Exception:
+                logger.error(f'Could not get lyrics for {media_id}, unexpected error: {traceback.format_exc()}')
+        os.replace(path, filepath)
+        logger.info(f"Downloaded {job['item_type']} by id '{media_id}'")
+        worker.progress.emit([media_id, worker.tr("Downloaded"), [100, 100], filepath, job['display_name']])
+
+
+post_processor = PostProcessor()
@@ -0,0 +1,48 @@
+import threading
+from PyQt6.QtCore import QObject, QTimer, pyqtSignal
+from ..otsconfig import config
+
+
+class ProgressAggregator(QObject):
+    # Download workers store their byte counters here instead of emitting a signal for every chunk. A timer on the
+    # GUI thread publishes the latest counters of all active items as one batch, status changes still go through
+    # the workers' own progress signals right away.
+    batch = pyqtSignal(dict)
+
+    def __init__(self):
+        super().__init__()
+        self.__lock = threading.Lock()
+        self.__pending = {}
+        self.__timer = None
+
+    def update(self, media_id, downloaded, total):
+        with self.__lock:
+            self.__pending[media_id] = [downloaded, total]
+
+    def take(self, media_id):
+        with self.__lock:
+            return self.__pending.pop(media_id, None)
+
+    def drain(self):
+        with self.__lock:
+            pending, self.__pending = self.__pending, {}
+        return pending
+
+    def publish(self):
+        pending = self.drain()
+        if pending:
+            self.batch.emit(pending)
+
+    def start(self):
+        # Call from the GUI thread, the timer fires on the thread that started it
+        if self.__timer is None:
+            self.__timer = QTimer(self)
+            self.__timer.timeout.connect(self.publish)
+        self.__timer.start(config.get('progress_refresh_ms'))
+
+    def stop(self):
+        if self.__timer is not None:
+            self.__timer.stop()
+
+
+progress_aggregator = ProgressAggregator()
@@ -0,0 +1,139 @@
+import hashlib
+import random
+import threading
+import time
+from ..otsconfig import config
+from ..runtimedata import get_logger
+
+logger = get_logger("spotify.ratelimit")
+
+RATE_LIMITED_HOSTS = ['api.spotify.com', 'spclient.wg.spotify.com']
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+# Only these are sent again automatically, a PUT or POST may already have been applied before the error
+RETRY_METHODS = ['GET', 'HEAD']
+# Buckets untouched for this long are dropped, access tokens rotate so old account keys go stale
+_IDLE_BUCKET_TIMEOUT = 900
+
+
+def account_key(headers):
+    auth = (headers or {}).get('Authorization', '')
+    return hashlib.md5(auth.encode()).hexdigest()[:12] if auth else 'anonymous'
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self, now):
+        # Takes a token and returns how long the caller has to wait for it, the balance may go negative
+        # so later callers queue up behind earlier ones
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class RequestScheduler:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__buckets = {}
+        self.__cooldowns = {}
+        self.__waited = 0.0
+        self.__throttled = 0
+        self.__retried = 0
+        self.__last_cleanup = time.monotonic()
+
+    def __bucket(self, key, now):
+        bucket = self.__buckets.get(key)
+        if bucket is None:
+            bucket = self.__buckets[key] = TokenBucket(config.get('api_rate_limit'), config.get('api_rate_burst'))
+        if now - self.__last_cleanup > _IDLE_BUCKET_TIMEOUT:
+            self.__last_cleanup = now
+            for stale in [k for k, b in self.__buckets.items() if now - b.updated > _IDLE_BUCKET_TIMEOUT]:
+                self.__buckets.pop(stale)
+        return bucket
+
+    def acquire(self, account, host):
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                cooldown = max(self.__cooldowns.get(host, 0), self.__cooldowns.get((account, host), 0)) - now
+                wait = cooldown if cooldown > 0 else self.__bucket((account, host), now).reserve(now)
+                self.__waited += wait
+            if wait <= 0:
+                return
+            logger.debug(f'Waiting {wait:.2f}s for api budget on {host}')
+            time.sleep(wait)
+            if cooldown <= 0:
+                return
+
+    def penalize(self, account, host, delay):
+        # A 429 is shared by every request to the host, not only the one that received it
+        with self.__lock:
+            until = time.monotonic() + delay
+            self.__throttled += 1
+            for key in [host, (account, host)]:
+                self.__cooldowns[key] = max(self.__cooldowns.get(key, 0), until)
+
+    def request(self, host, headers, send, method='GET'):
+        account = account_key(headers)
+        retry = method.upper() in RETRY_METHODS
+        attempts = config.get('api_max_attempts') if retry else 1
+        for attempt in range(attempts):
+            self.acquire(account, host)
+            response = send()
+            if response.status_code not in RETRY_STATUS_CODES:
+                return response
+            if attempt == attempts - 1:
+                if response.status_code == 429:
+                    # Not retried, but later requests to the host still have to back off
+                    delay = self.retry_delay(response, attempt)
+                    if delay is not None:
+                        self.penalize(account, host, delay)
+                return response
+            delay = self.retry_delay(response, attempt)
+            if delay is None:
+                return response
+            logger.warning(f'Got {response.status_code} from {host}, retrying in {delay:.2f}s '
+                           f'(attempt {attempt + 1}/{attempts})')
+            with self.__lock:
+                self.__retried += 1
+            if response.status_code == 429:
+                self.penalize(account, host, delay)
+            else:
+                time.sleep(delay)
+        return response
+
+    def retry_delay(self, response, attempt):
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                delay = None
+            if delay is not None:
+                if delay > config.get('api_max_retry_after'):
+                    logger.error(f'Retry-After of {delay}s exceeds api_max_retry_after, giving up')
+                    return None
+                return delay + random.uniform(0, 1)
+        return config.get('api_backoff_base') * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def stats(self):
+        with self.__lock:
+            now = time.monotonic()
+            buckets = {}
+            for (account, host), bucket in self.__buckets.items():
+                tokens = min(bucket.burst, bucket.tokens + (now - bucket.updated) * bucket.rate)
+                buckets[f'{account}@{host}'] = {
+                    'tokens': round(tokens, 2),
+                    'wait': round(max(-tokens / bucket.rate, 0), 2),
+                    'cooldown': round(max(self.__cooldowns.get((account, host), 0) - now, 0), 2),
+                }
+            return {'buckets': buckets, 'waited': round(self.__waited, 2), 'throttled': self.__throttled,
+                    'retried': self.__retried}
+
+
+scheduler = RequestScheduler()
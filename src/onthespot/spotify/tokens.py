@@ -0,0 +1,91 @@
+import threading
+import time
+from ..otsconfig import config
+from ..runtimedata import get_logger, session_pool
+
+logger = get_logger("spotify.tokens")
+
+# Never refresh the same token in the background more often than this
+_MIN_REFRESH_INTERVAL = 30
+
+
+def session_key(session):
+    for session_uuid, pooled in list(session_pool.items()):
+        if pooled is session:
+            return session_uuid
+    return str(id(session))
+
+
+def expire_early(provider, scope):
+    # Make librespot hand out a fresh token once ours enters the refresh window instead of its cached one. This is
+    # set on the cached token, TokenProvider.token_expire_threshold is class wide and would apply to every session.
+    token = provider.find_token_with_all_scopes([scope])
+    if token is not None and 'expired' not in vars(token):
+        threshold = config.get('token_refresh_margin') + 10
+        token.expired = lambda: token.timestamp / 1000000 + token.expires_in - threshold < time.time()
+
+
+class TokenManager:
+    # Access tokens cached per (session uuid, scope), refreshed in the background before they expire
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__tokens = {}
+        self.__pending = {}
+        self.__session_locks = {}
+
+    def get(self, session, scope):
+        key = (session_key(session), scope)
+        with self.__lock:
+            entry = self.__tokens.get(key)
+        now = time.time()
+        if entry is not None and entry[1] > now:
+            if entry[1] - now < config.get('token_refresh_margin') and now - entry[2] > _MIN_REFRESH_INTERVAL:
+                self.__refresh_async(session, scope, key)
+            return entry[0]
+        return self.__refresh(session, scope, key)
+
+    def __refresh_async(self, session, scope, key):
+        with self.__lock:
+            if key in self.__pending:
+                return
+        thread = threading.Thread(target=self.__refresh, args=(session, scope, key),
+                                  name=f'token-refresh-{key[0][:8]}', daemon=True)
+        thread.start()
+
+    def __refresh(self, session, scope, key):
+        with self.__lock:
+            event = self.__pending.get(key)
+            owner = event is None
+            if owner:
+                event = self.__pending[key] = threading.Event()
+            session_lock = self.__session_locks.setdefault(key[0], threading.Lock())
+        if not owner:
+            event.wait()
+            with self.__lock:
+                entry = self.__tokens.get(key)
+            if entry is not None:
+                return entry[0]
+            with session_lock:
+                return session.tokens().get(scope)
+        try:
+            # librespot's token provider is not thread safe, one fetch per session at a time
+            with session_lock:
+                provider = session.tokens()
+                expire_early(provider, scope)
+                stored = provider.get_token(scope)
+            expires_at = stored.timestamp / 1000000 + stored.expires_in
+            with self.__lock:
+                self.__tokens[key] = (stored.access_token, expires_at, time.time())
+            logger.debug(f'Token for scope "{scope}" refreshed, valid for {int(expires_at - time.time())}s')
+            return stored.access_token
+        finally:
+            with self.__lock:
+                self.__pending.pop(key, None)
+            event.set()
+
+
+token_manager = TokenManager()
+
+
+def get_token(session, scope):
+    return token_manager.get(session, scope)
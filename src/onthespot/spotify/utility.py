@@ -1,18 +1,43 @@
 import os
 import queue
 import time
+import traceback
+from concurrent.futures import as_completed
 from PyQt6.QtCore import QObject, pyqtSignal
 from urllib3.exceptions import MaxRetryError, NewConnectionError
 
 from ..otsconfig import config
-from ..runtimedata import get_logger, playlist_m3u_queue, downloaded_data, session_pool, unavailable
-from .api import get_album_tracks, get_album_name, get_artist_albums, get_show_episodes, get_episode_info, \
-    get_song_info, get_tracks_from_playlist, get_playlist_data
+from ..runtimedata import get_logger, playlist_m3u_queue, playlist_m3u_lock, downloaded_data, session_pool, unavailable, song_info_store
+from .api import get_album_tracks, get_album_name, get_album_name_from_data, get_artist_discography, \
+    get_show_episodes, get_episode_info, get_episodes_data, get_song_info, get_song_info_many, get_playlist_tracks_by_snapshot, get_playlist_data, \
+    get_playlist_paths, set_playlist_paths, search_by_type, metadata_executor, batched
 from ..utils.utils import re_init_session, fetch_account_uuid
 
 logger = get_logger("worker.utility")
 
 
+def write_m3u_playlist(play_id, filename, tracks):
+    # Write the m3u8 header
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w', encoding='UTF-8') as f:
+        f.write('#EXTM3U\n')
+    tid = 1
+    entries = {}
+    for track_id in tracks:
+        logger.info(f'Playlist: {play_id}, adding track: {track_id} to m3u8')
+        if track_id in unavailable:
+            logger.info(f'Playlist: {play_id}, track: {track_id}  unavailable for adding, skipping')
+            continue
+        with open(filename, 'a', encoding='UTF-8') as f:
+            f.write(
+                f'#EXTINF:{tid}, {downloaded_data[track_id]["media_name"]}\n'
+                f'{downloaded_data[track_id]["media_path"]}\n'
+            )
+        entries[track_id] = downloaded_data[track_id]
+        tid = tid + 1
+    set_playlist_paths(play_id, entries)
+
+
 class PlayListMaker(QObject):
     changed_media = pyqtSignal(str, bool)
     finished = pyqtSignal()
@@ -22,32 +47,22 @@ class PlayListMaker(QObject):
         logger.info('Playlist m3u8 builder is running....')
         while not self.__stop:
             downloaded_and_available = set(downloaded_data.keys()).difference(unavailable)
-            for play_id in list(playlist_m3u_queue.keys()):
+            with playlist_m3u_lock:
+                entries = dict(playlist_m3u_queue)
+            for play_id, entry in entries.items():
                 logger.info(f'Playlist m3u8 checking ID {play_id}')
                 # Remove unavailable tracks from playlist items and see if all of its item are available in
                 # downloaded_and_available set
-                all_downloadable_in_playlist = set(playlist_m3u_queue[play_id]['tracks']).difference(unavailable)
+                all_downloadable_in_playlist = set(entry['tracks']).difference(unavailable)
                 if all_downloadable_in_playlist.issubset(downloaded_and_available):
                     logger.info(f'Playlist {play_id} has all items ready, making m3u8 playlist at: '
-                                f'{{play_queue[play_id]["filename"]}}!')
-                    # Write the m3u8 header
-                    os.makedirs(os.path.dirname(playlist_m3u_queue[play_id]['filename']), exist_ok=True)
-                    with open(playlist_m3u_queue[play_id]['filename'], 'w', encoding='UTF-8') as f:
-                        f.write('#EXTM3U\n')
-                    tid = 1
-                    for track_id in playlist_m3u_queue[play_id]['tracks']:
-                        logger.info(f'Playlist: {play_id}, adding track: {track_id} to m3u8')
-                        if track_id in unavailable:
-                            logger.info(f'Playlist: {play_id}, track: {track_id}  unavailable for adding, skipping')
-                            continue
-                        with open(playlist_m3u_queue[play_id]['filename'], 'a', encoding='UTF-8') as f:
-                            f.write(
-                                f'#EXTINF:{tid}, {downloaded_data[track_id]["media_name"]}\n'
-                                f'{downloaded_data[track_id]["media_path"]}\n'
-                            )
-                        tid = tid + 1
+                                f'{entry["filename"]}!')
+                    write_m3u_playlist(play_id, entry['filename'], entry['tracks'])
                     logger.info(f'Playlist: {play_id} created, removing fro queue list')
-                    playlist_m3u_queue.pop(play_id)
+                    with playlist_m3u_lock:
+                        # A newer snapshot queued meanwhile still has to be written
+                        if playlist_m3u_queue.get(play_id) is entry:
+                            playlist_m3u_queue.pop(play_id)
                 else:
                     logger.info(f"Playlist {play_id} has some items left to download")
             time.sleep(4)
@@ -64,26 +79,70 @@ class ParsingQueueProcessor(QObject):
     __queue = None
     __stop = True
 
-    def enqueue_tracks(self, track_list, enqueue_part_cfg, log_id='', item_type=''):
-        for track in track_list:
-            logger.info(f'PQP parsing {log_id} <-> track item: {track["name"]}:{track["id"]}')
-            exp = config.get("explicit_label") if track['explicit'] else ''
+    def prefetch_song_info(self, session, track_ids):
+        # Resolve metadata for the whole batch up front so download workers can skip per track lookups
+        track_ids = [track_id for track_id in track_ids if track_id not in song_info_store]
+        if not track_ids:
+            return
+        try:
+            song_info_store.update(get_song_info_many(session, track_ids))
+        except Exception:
+            logger.error(f'Metadata prefetch failed, tracks will be resolved while downloading: {traceback.format_exc()}')
+
+    def enqueue_tracks(self, track_list, enqueue_part_cfg, log_id='', item_type='', session=None):
+        prefetch = session is not None and config.get('prefetch_track_metadata')
+        # Metadata is resolved one batch ahead of the enqueue, so workers find it stored when they pick a track up
+        for batch in batched(track_list, 50):
+            if prefetch:
+                self.prefetch_song_info(session, [track['id'] for track in batch])
+            for track in batch:
+                self.enqueue_track(track, enqueue_part_cfg, log_id, item_type)
+
+    def enqueue_track(self, track, enqueue_part_cfg, log_id, item_type):
+        logger.info(f'PQP parsing {log_id} <-> track item: {track["name"]}:{track["id"]}')
+        exp = config.get("explicit_label") if track['explicit'] else ''
+        self.enqueue.emit(
+            {
+                'item_id': track['id'],
+                'item_title': f'{exp} {track["name"]}',
+                'item_by_text': f"{config.get('metadata_seperator').join([artist['name'] for artist in track.get('artists', [])])}",
+                'item_type_text': item_type,
+                'dl_params': {
+                    'media_type': 'track',
+                    'extra_paths': enqueue_part_cfg.get('extra_paths', ''),
+                    'extra_path_as_root': bool(enqueue_part_cfg.get('extra_path_as_root', False)),
+                    'playlist_name': enqueue_part_cfg.get('playlist_name', ''),
+                    'playlist_owner': enqueue_part_cfg.get('playlist_owner', ''),
+                    'playlist_desc': enqueue_part_cfg.get('playlist_desc', ''),
+                }
+            }
+        )
+
+    def enqueue_episodes(self, session, episode_ids, extra_paths, extra_path_as_root, log_id='', item_type=None):
+        # Episodes missing from the store, evicted or never listed, are resolved in batches before the enqueue
+        get_episodes_data(session, episode_ids)
+        show_name = None
+        for episode_id in episode_ids:
+            show_name, episode_name, thumbnail, release_date, total_episodes, artist, language, description, copyright, length = get_episode_info(session, episode_id)
+            logger.info(
+                f"PQP parsing podcast : {show_name}:{log_id}, "
+                f"episode item: {episode_name}:{episode_id}"
+            )
+            # TODO: Use new enqueue method
             self.enqueue.emit(
                 {
-                    'item_id': track['id'],
-                    'item_title': f'{exp} {track["name"]}',
-                    'item_by_text': f"{config.get('metadata_seperator').join([artist['name'] for artist in track.get('artists', [])])}",
-                    'item_type_text': item_type,
+                    'item_id': episode_id,
+                    'item_title': episode_name,
+                    'item_by_text': '',
+                    'item_type_text': item_type or f"Podcast [{show_name}]",
                     'dl_params': {
-                        'media_type': 'track',
-                        'extra_paths': enqueue_part_cfg.get('extra_paths', ''),
-                        'extra_path_as_root': bool(enqueue_part_cfg.get('extra_path_as_root', False)),
-                        'playlist_name': enqueue_part_cfg.get('playlist_name', ''),
-                        'playlist_owner': enqueue_part_cfg.get('playlist_owner', ''),
-                        'playlist_desc': enqueue_part_cfg.get('playlist_desc', ''),
+                        'media_type': 'episode',
+                        'extra_paths': extra_paths,
+                        'extra_path_as_root': extra_path_as_root,
                     }
                 }
             )
+        return show_name
 
     def run(self):
         logger.info('Parsing queue processor is active !')
@@ -111,47 +170,31 @@ class ParsingQueueProcessor(QObject):
                     logger.info("Passing control to track downloader.py for album tracks downloading !!")
                     self.enqueue_tracks(tracks, enqueue_part_cfg=enqueue_part_cfg,
                                         log_id=f'{album_name}:{item["media_id"]}',
-                                        item_type=f"Album [{album_release_date}][{album_name}]")
+                                        item_type=f"Album [{album_release_date}][{album_name}]",
+                                        session=session)
                     if not item['data'].get('hide_dialogs', False):
                         self.progress.emit(self.tr("Added album {0} to download queue !").format(album_name))
                 elif item['media_type'] == 'artist':
                     item_name = item['data'].get('media_title', 'the artist')
                     if not item['data'].get('hide_dialogs', False):
                         self.progress.emit(self.tr("All albums by {0} are being parsed and will be added to download queue soon!").format(item_name))
-                    albums = get_artist_albums(session, item['media_id'])
-                    for album_id in albums:
-                        artist, album_release_date, album_name, total_tracks = get_album_name(session, album_id)
+                    for album, tracks in get_artist_discography(session, item['media_id']):
+                        artist, album_release_date, album_name, total_tracks = get_album_name_from_data(album)
                         item_name = artist
-                        tracks = get_album_tracks(session, album_id)
                         logger.info("Passing control to track downloader.py for album artist downloading !!")
                         self.enqueue_tracks(tracks, enqueue_part_cfg=enqueue_part_cfg,
-                                            log_id=f'{artist}:{item["media_id"]}', item_type=f"Artist [{item_name}]")
+                                            log_id=f'{artist}:{item["media_id"]}', item_type=f"Artist [{item_name}]",
+                                            session=session)
                     if not item['data'].get('hide_dialogs', False):
                         self.progress.emit(self.tr("Added tracks by artist '{0}' to download queue !").format(item_name))
                 elif item['media_type'] in ['podcast', 'show', 'audiobook']:
                     show_name = ''
                     if not item['data'].get('hide_dialogs', False):
                         self.progress.emit(self.tr('Episodes are being parsed and will be added to download queue shortly !'))
-                    for episode_id in get_show_episodes(session, item['media_id']):
-                        show_name, episode_name, thumbnail, release_date, total_episodes, artist, language, description, copyright, length = get_episode_info(session, episode_id)
-                        logger.info(
-                            f"PQP parsing podcast : {show_name}:{item['media_id']}, "
-                            f"episode item: {episode_name}:{episode_id}"
-                        )
-                        # TODO: Use new enqueue method
-                        self.enqueue.emit(
-                            {
-                                'item_id': episode_id,
-                                'item_title': episode_name,
-                                'item_by_text': '',
-                                'item_type_text': f"Podcast [{show_name}]",
-                                'dl_params': {
-                                    'media_type': 'episode',
-                                    'extra_paths': item['data'].get('dl_path', ''),
-                                    'extra_path_as_root': item['data'].get('dl_path_is_root', False),
-                                }
-                            }
-                        )
+                    episode_ids = get_show_episodes(session, item['media_id'])
+                    show_name = self.enqueue_episodes(session, episode_ids, item['data'].get('dl_path', ''),
+                                                      item['data'].get('dl_path_is_root', False),
+                                                      log_id=item['media_id']) or show_name
                     if not item['data'].get('hide_dialogs', False):
                         self.progress.emit(self.tr("Added show {0} to download queue!").format(show_name))
                 elif item['media_type'] == 'episode':
@@ -177,37 +220,63 @@ class ParsingQueueProcessor(QObject):
                         self.progress.emit(self.tr("Added {0} to download queue!").format(podcast_name))
                 elif item['media_type'] == "playlist":
                     enable_m3u = config.get('create_m3u_playlists', False)
-                    name, owner, description, url = get_playlist_data(session, item["media_id"])
+                    name, owner, description, url, snapshot_id = get_playlist_data(session, item["media_id"])
                     item_name = item['data'].get('media_title', name)
                     if not item['data'].get('hide_dialogs', False):
                         self.progress.emit(self.tr("Tracks in playlist '{0}' are being parsed \n and will be added to download queue shortly!").format(item_name))
-                    playlist_songs = get_tracks_from_playlist(session,
-                                                              item['media_id'])
+                    tracks, added, removed = get_playlist_tracks_by_snapshot(session, item['media_id'], snapshot_id)
                     enqueue_part_cfg.update({
                         'playlist_name': name,
                         'playlist_owner': owner,
                         'playlist_desc': description
                     })
                     if enable_m3u:
-                        playlist_m3u_queue[item['media_id']] = {
+                        # Replaces an entry still waiting on downloads so the m3u8 reflects the latest snapshot
+                        m3u_entry = {
                             'filename': os.path.abspath(
                                 os.path.join(
                                     config.get('download_root'),
                                     config.get('m3u_name_formatter').format(name=name, owner=owner,
                                                                                  description=description) + ".m3u8")
                             ),
-                            'tracks': []
+                            'tracks': [track['id'] for track in tracks]
                         }
-                    for song in playlist_songs:
-                        if song['track']['id'] is not None:
-                            if enable_m3u:
-                                playlist_m3u_queue[item['media_id']]['tracks'].append(song['track']['id'])
-                            self.enqueue_tracks([song['track']], enqueue_part_cfg=enqueue_part_cfg,
-                                                log_id=f'{item_name}:{item["media_id"]}', item_type=f"Playlist [{name}]")
+                        with playlist_m3u_lock:
+                            playlist_m3u_queue[item['media_id']] = m3u_entry
+                    if config.get('incremental_playlist_sync') and added is not None:
+                        logger.info(f'Playlist {item["media_id"]} synced incrementally, {len(added)} new tracks, '
+                                    f'{len(removed)} removed')
+                        stored_paths = get_playlist_paths(item['media_id'])
+                        if any(track_id in stored_paths for track_id in removed):
+                            # Tracks taken out of the playlist are not listed in the regenerated m3u8 either
+                            stored_paths = {track_id: entry for track_id, entry in stored_paths.items()
+                                            if track_id not in removed}
+                            set_playlist_paths(item['media_id'], stored_paths)
+                        if enable_m3u:
+                            # Tracks from earlier runs are listed from the paths stored with the last m3u8, the
+                            # ones without a file on disk are queued again so the playlist can be completed
+                            for track_id, entry in stored_paths.items():
+                                if track_id not in downloaded_data and os.path.exists(entry['media_path']):
+                                    downloaded_data[track_id] = entry
+                            added_ids = {track['id'] for track in added}
+                            tracks = [track for track in tracks
+                                      if track['id'] in added_ids or track['id'] not in downloaded_data]
+                        else:
+                            tracks = added
+                    episode_ids = [track['id'] for track in tracks if track.get('type') == 'episode']
+                    if episode_ids:
+                        self.enqueue_episodes(session, episode_ids, enqueue_part_cfg.get('extra_paths', ''),
+                                              bool(enqueue_part_cfg.get('extra_path_as_root', False)),
+                                              log_id=item['media_id'], item_type=f"Playlist [{name}]")
+                        tracks = [track for track in tracks if track.get('type') != 'episode']
+                    self.enqueue_tracks(tracks, enqueue_part_cfg=enqueue_part_cfg,
+                                        log_id=f'{item_name}:{item["media_id"]}', item_type=f"Playlist [{name}]",
+                                        session=session)
                     if not item['data'].get('hide_dialogs', False):
                         self.progress.emit(self.tr("Added playlist '{0}' to download queue !").format(item_name))
                 elif item['media_type'] == 'track':
                     song_info = get_song_info(session, item['media_id'])
+                    song_info_store[item['media_id']] = song_info
                     name = song_info['name']
                     if not item['data'].get('hide_dialogs', False):
                         self.progress.emit(self.tr("Adding track '{0}' to download queue !").format(name))
@@ -232,3 +301,47 @@ class ParsingQueueProcessor(QObject):
     def setup(self, queue):
         self.__queue = queue
         self.__stop = 0
+
+
+class SearchWorker(QObject):
+    # Runs each result type of a search as its own request so the table fills in as pages arrive
+    finished = pyqtSignal()
+    # search id, result type, items, offset of the next page, total
+    results = pyqtSignal(str, str, list, int, int)
+    done = pyqtSignal(str, int)
+    __queue = None
+    __stop = True
+
+    def run(self):
+        logger.info('Search worker is active !')
+        while not self.__stop:
+            search = self.__queue.get()
+            selected_uuid = fetch_account_uuid(False)
+            session = session_pool[selected_uuid]
+            logger.info(f"Searching '{search['term']}' for {search['types']} from offset {search['offset']}")
+            futures = {
+                metadata_executor.submit(search_by_type, session, search['term'], c_type, search['limit'],
+                                         search['offset']): c_type
+                for c_type in search['types']
+            }
+            found = 0
+            try:
+                for future in as_completed(futures):
+                    items, total, next_offset = future.result()
+                    found += len(items)
+                    # A page of nothing but nulls still moves the offset on
+                    if next_offset == search['offset']:
+                        next_offset = total
+                    self.results.emit(search['id'], futures[future], items, next_offset, total)
+            except (OSError, queue.Empty, MaxRetryError, NewConnectionError, ConnectionError):
+                # Internet disconnected ?
+                logger.error('Search failed Connection error ! Trying to re init parsing account session ! ')
+                re_init_session(session_pool, selected_uuid, wait_connectivity=False)
+            except Exception:
+                logger.error(f"Search failed for '{search['term']}': {traceback.format_exc()}")
+            self.done.emit(search['id'], found)
+        logger.warning('Search worker is stopping !')
+
+    def setup(self, queue):
+        self.__queue = queue
+        self.__stop = False
@@ -0,0 +1,17 @@
+import os
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(ROOT_DIR, 'src')
+# The mock backend and fake session of the benchmarks double as test fixtures
+BENCH_DIR = os.path.join(ROOT_DIR, 'benchmarks')
+
+# onthespot reads its config, cache and log locations at import time, keep them out of the user's profile
+_workdir = tempfile.mkdtemp(prefix='ots-test-')
+for var in ['XDG_CONFIG_HOME', 'XDG_CACHE_HOME', 'APPDATA', 'TEMP']:
+    os.environ[var] = _workdir
+os.environ.setdefault('LOG_LEVEL', '30')
+for path in [SRC_DIR, BENCH_DIR]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
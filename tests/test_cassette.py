@@ -0,0 +1,46 @@
+import sys
+
+import pytest
+
+from mock_backend import Catalog, MockBackend
+from onthespot.spotify import api, http_client
+from onthespot.spotify.cache import CacheStore
+from onthespot.spotify.cassette import Cassette
+
+cassette_module = sys.modules['onthespot.spotify.cassette']
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    catalog = Catalog(4)
+    backend = MockBackend(catalog).start()
+    client = http_client.HttpClient()
+    client.override_host('api.spotify.com', backend.url)
+    monkeypatch.setattr(api, 'client', client)
+    yield catalog, backend
+    backend.stop()
+
+
+def use_cassette(monkeypatch, cassette):
+    monkeypatch.setattr(cassette_module, 'cassette', cassette)
+    monkeypatch.setattr(http_client, 'cassette', cassette)
+
+
+def test_recording_with_a_warm_cache_replays(monkeypatch, tmp_path, backend):
+    catalog, server = backend
+    url = f'https://api.spotify.com/v1/playlists/{catalog.playlist_id}'
+    monkeypatch.setattr(api, 'cache', CacheStore(str(tmp_path / 'warm.db')))
+    expected = api.make_call(url, token='token')
+    assert expected is not None
+
+    use_cassette(monkeypatch, Cassette('record', str(tmp_path / 'cassette')))
+    requests_before = server.requests
+    assert api.make_call(url, token='token') == expected
+    assert server.requests == requests_before + 1
+
+    replay = Cassette('replay', str(tmp_path / 'cassette'))
+    use_cassette(monkeypatch, replay)
+    monkeypatch.setattr(api, 'cache', CacheStore(str(tmp_path / 'cold.db')))
+    assert api.make_call(url, token='token') == expected
+    assert replay.stats()['hits'] == 1
+    assert replay.stats()['misses'] == 0
@@ -0,0 +1,45 @@
+import io
+import os
+
+import pytest
+
+from onthespot.spotify.chunkreader import ChunkReader, ChunkSizer, supports_readinto
+
+
+class BytesIOStream(io.BytesIO):
+    # Shaped like librespot's AbsChunkedInputStream, read() is overridden and the inherited readinto is not usable
+    def __init__(self, payload):
+        super().__init__()
+        self.__payload = payload
+        self.__position = 0
+
+    def read(self, size=-1):
+        data = self.__payload[self.__position:self.__position + size]
+        self.__position += len(data)
+        return data
+
+
+class ReadintoStream:
+    def __init__(self, payload):
+        self.__payload = memoryview(payload)
+        self.__position = 0
+
+    def readinto(self, buffer):
+        size = min(len(buffer), len(self.__payload) - self.__position)
+        buffer[:size] = self.__payload[self.__position:self.__position + size]
+        self.__position += size
+        return size
+
+
+@pytest.mark.parametrize('stream_type, readinto', [(BytesIOStream, False), (ReadintoStream, True)])
+def test_chunks_are_written_unchanged(stream_type, readinto):
+    payload = os.urandom(1000003)
+    stream = stream_type(payload)
+    assert supports_readinto(stream) is readinto
+    out = io.BytesIO()
+    reader = ChunkReader(stream, out, ChunkSizer())
+    downloaded = 0
+    while downloaded < len(payload):
+        downloaded += reader.read(min(65536, len(payload) - downloaded))
+    reader.close()
+    assert out.getvalue() == payload
@@ -0,0 +1,37 @@
+import math
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+
+from onthespot.spotify import api
+from onthespot.spotify.cache import episode_cache
+
+
+@pytest.fixture
+def episode_calls(monkeypatch):
+    calls = []
+
+    def make_call(url, **kwargs):
+        calls.append(url)
+        ids = parse_qs(urlsplit(url).query)['ids'][0].split(',')
+        return {'episodes': [{'id': episode_id, 'name': episode_id} for episode_id in ids]}
+
+    monkeypatch.setattr(api, 'make_call', make_call)
+    monkeypatch.setattr(api, 'get_token', lambda session, scope: 'token')
+    return calls
+
+
+@pytest.mark.parametrize('count', [1, 50, 51, 120])
+def test_uncached_episodes_cost_one_request_per_50(episode_calls, count):
+    episode_ids = [f'uncached{count}x{i}' for i in range(count)]
+    api.get_episodes_data(None, episode_ids)
+    assert len(episode_calls) == math.ceil(count / 50)
+    assert all(episode_cache.get(episode_id) is not None for episode_id in episode_ids)
+
+
+def test_cached_episodes_are_not_requested_again(episode_calls):
+    episode_ids = [f'cached{i}' for i in range(60)]
+    api.get_episodes_data(None, episode_ids[:10])
+    api.get_episodes_data(None, episode_ids)
+    assert len(episode_calls) == 2
+    assert episode_calls[1].count(',') == 49
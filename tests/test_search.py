@@ -0,0 +1,11 @@
+from onthespot.spotify import api
+
+
+def test_next_offset_counts_null_padding(monkeypatch):
+    page = {'tracks': {'items': [{'id': 'a'}, None, {'id': 'b'}, None], 'total': 10}}
+    monkeypatch.setattr(api, 'make_call', lambda url, **kwargs: page)
+    monkeypatch.setattr(api, 'get_token', lambda session, scope: 'token')
+    items, total, next_offset = api.search_by_type(None, 'term', 'track', 4, offset=4)
+    assert [item['id'] for item in items] == ['a', 'b']
+    assert total == 10
+    assert next_offset == 8
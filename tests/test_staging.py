@@ -0,0 +1,30 @@
+import os
+import time
+
+from onthespot.spotify.postprocess import staging_path, sweep_staging
+
+
+def test_staging_is_next_to_the_destination_and_unique(tmp_path):
+    filepath = str(tmp_path / 'Artist' / 'Album' / '1. Track.mp3')
+    first, second = staging_path(filepath), staging_path(filepath)
+    assert first != second
+    assert os.path.dirname(first) == os.path.dirname(filepath)
+    assert os.path.basename(first).startswith('.1. Track.')
+    assert first.endswith('.part.mp3')
+
+
+def test_sweep_removes_only_stale_partial_files(tmp_path):
+    filepath = str(tmp_path / 'Album' / 'Track.mp3')
+    stale = staging_path(filepath)
+    converting = os.path.join(os.path.dirname(stale), '.~' + os.path.splitext(os.path.basename(stale))[0] + '.ogg')
+    for path in [stale, converting, filepath]:
+        with open(path, 'wb') as f:
+            f.write(b'data')
+        os.utime(path, (time.time() - 60, time.time() - 60))
+    fresh = staging_path(filepath)
+    with open(fresh, 'wb') as f:
+        f.write(b'data')
+    os.utime(fresh, (time.time() + 60, time.time() + 60))
+
+    assert sweep_staging(str(tmp_path)) == 2
+    assert sorted(os.listdir(tmp_path / 'Album')) == sorted([os.path.basename(fresh), 'Track.mp3'])